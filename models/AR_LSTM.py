@@ -1,5 +1,6 @@
 import torch
 import torch.nn as nn
+from models.rollout import rollout
 
 
 class AR_LSTM(nn.Module):
@@ -66,11 +67,12 @@ class AR_LSTM(nn.Module):
     def get_num_output_frames(self):
         return self.num_output_frames
 
-    def forward(self, x, mode="initial_input"):
+    def _step(self, x, mode):
+        # Updates the LSTM state only. x is None when propagating
         if (mode == "initial_input") or (mode == 'reinsert'):
             x = self.encoder_conv(x)
             self.org_size = x.size()
-            x = x.view(-1, 30720)
+            x = x.reshape(-1, 30720)
             x = self.encoder_linear(x)
             if mode == "initial_input":
                 self.h0, self.c0 = self.LSTM_initial_input(x, (self.h0, self.c0))
@@ -78,41 +80,130 @@ class AR_LSTM(nn.Module):
                 self.h0, self.c0 = self.LSTM_reinsert(x, (self.h0, self.c0))
         elif mode == "propagate":
             self.h0, self.c0 = self.LSTM_propagation(self.h0, (self.h0, self.c0))
-        x = self.h0.clone()
-        x = self.decoder_linear(x)
-        x = x.view(self.org_size)
-        x = self.decoder_conv(x)
-        return x
+
+    def decode(self, h):
+        # Decodes any number of hidden states (N x LSTM_SIZE) to frames (N x 1 x H x W)
+        x = self.decoder_linear(h)
+        x = x.view((-1,) + tuple(self.org_size[1:]))
+        return self.decoder_conv(x)
+
+    def forward(self, x, mode="initial_input"):
+        self._step(x, mode)
+        return self.decode(self.h0.clone())
 
     def reset_hidden(self, batch_size):
         self.h0 = torch.zeros((batch_size, self.LSTM_SIZE)).to(self.device)
         self.c0 = torch.zeros((batch_size, self.LSTM_SIZE)).to(self.device)
 
+    def _decode_many(self, hidden_states):
+        # B x T x LSTM_SIZE are decoded as one batch of B*T states
+        hidden = torch.stack(hidden_states, dim=1)
+        batch_size, num_frames = hidden.size(0), hidden.size(1)
+        frames = self.decode(hidden.reshape(batch_size * num_frames, self.LSTM_SIZE))
+        return frames.view(batch_size, num_frames, frames.size(2), frames.size(3))
+
+    def forward_many_batched(self, input_frames, num_total_output_frames):
+        """
+        Runs only the LSTM cells step by step and decodes the hidden states between two reinsertions in one batch.
+        Equal to forward_many in eval mode, in training mode the batch norm statistics would span all time steps
+        """
+        self.reset_hidden(batch_size=input_frames.size(0))
+        output_frames = []
+        hidden_states = []
+        for future_frame_idx in range(num_total_output_frames):
+            if future_frame_idx == 0:
+                self._step(input_frames, 'initial_input')
+            elif (future_frame_idx % self.reinsert_frequency) == 0:
+                # The reinserted frames have to be decoded first
+                output_frames.append(self._decode_many(hidden_states))
+                hidden_states = []
+                input_frames = torch.cat(output_frames[-self.num_input_frames:], dim=1)[:, -self.num_input_frames:]
+                self._step(input_frames, 'reinsert')
+            else:
+                self._step(None, 'propagate')
+            hidden_states.append(self.h0)
+        output_frames.append(self._decode_many(hidden_states))
+        return torch.cat(output_frames, dim=1)
+
     def forward_many(self, input_frames, num_total_output_frames):
+        if not self.training:
+            return self.forward_many_batched(input_frames, num_total_output_frames)
         self.reset_hidden(batch_size=input_frames.size(0))
+        output_frames = []
         for future_frame_idx in range(num_total_output_frames):
             if future_frame_idx == 0:
-                output_frames = self(input_frames, mode='initial_input')
+                output_frames.append(self(input_frames, mode='initial_input'))
             elif (future_frame_idx % self.reinsert_frequency) == 0:
-                input_frames = output_frames[:, -self.num_input_frames:, :, :].clone()
-                output_frames = torch.cat((output_frames, self(input_frames, mode="reinsert")), dim=1)
+                input_frames = torch.cat(output_frames[-self.num_input_frames:], dim=1)
+                output_frames.append(self(input_frames, mode="reinsert"))
             else:
-                output_frames = torch.cat((output_frames, self(torch.Tensor([0]), mode="propagate")), dim=1)
-        return output_frames
+                output_frames.append(self(None, mode="propagate"))
+        return torch.cat(output_frames, dim=1)
 
-    def get_future_frames_refeed(self, input_frames, num_total_output_frames):
-        num_input_frames = self.get_num_input_frames()
-        num_output_frames = self.get_num_output_frames()
-        output_frames = self.forward_many(input_frames, num_output_frames)
-
-        while output_frames.size(1) < num_total_output_frames:
-            if output_frames.size(1) < num_input_frames:
-                keep_from_input = num_input_frames - output_frames.size(1)
-                input_frames = torch.cat((input_frames[:, -keep_from_input:, :, :], output_frames), dim=1)
+    def init_state(self, batch_size):
+        return {'window': None, 'h': None, 'c': None, 'output': None}
+
+    def observe(self, state, frame):
+        """
+        Adds a frame (B x 1 x H x W) to the window of the last num_input_frames frames. The first full window is
+        encoded from zero states, every later one is reinserted into the current states
+        """
+        window = frame if state['window'] is None else torch.cat((state['window'], frame), dim=1)[:, -self.num_input_frames:]
+        state['window'] = window
+        if window.size(1) < self.num_input_frames:
+            return state
+        if state['h'] is None:
+            self.reset_hidden(batch_size=frame.size(0))
+            state['output'] = self(window, mode='initial_input')
+        else:
+            self.h0, self.c0 = state['h'], state['c']
+            state['output'] = self(window, mode='reinsert')
+        state['h'], state['c'] = self.h0, self.c0
+        return state
+
+    def predict(self, state, num_frames):
+        # The first frame is the one decoded from the last observation, the rest follow the schedule of forward_many
+        if state['output'] is None:
+            raise ValueError('Fewer than %d frames observed' % self.num_input_frames)
+        self.h0, self.c0 = state['h'], state['c']
+        output_frames = [state['output']]
+        for future_frame_idx in range(1, num_frames):
+            if (future_frame_idx % self.reinsert_frequency) == 0:
+                input_frames = torch.cat(output_frames[-self.num_input_frames:], dim=1)
+                output_frames.append(self(input_frames, mode="reinsert"))
+            else:
+                output_frames.append(self(None, mode="propagate"))
+        return torch.cat(output_frames, dim=1)
+
+    def get_future_frames_chunks(self, input_frames, num_total_output_frames, chunk_size):
+        """
+        Truncated backpropagation through time: yields the predictions in chunks of chunk_size frames
+        and detaches the LSTM state and the frames kept for reinsertion between the chunks
+        """
+        self.reset_hidden(batch_size=input_frames.size(0))
+        output_frames = []
+        num_chunk_frames = 0
+        for future_frame_idx in range(num_total_output_frames):
+            if future_frame_idx == 0:
+                output_frames.append(self(input_frames, mode='initial_input'))
+            elif (future_frame_idx % self.reinsert_frequency) == 0:
+                input_frames = torch.cat(output_frames[-self.num_input_frames:], dim=1)
+                output_frames.append(self(input_frames, mode="reinsert"))
             else:
-                input_frames = output_frames[:, -num_input_frames:, :, :].clone()
-            output_frames = torch.cat((output_frames, self.forward_many(input_frames, num_output_frames)), dim=1)
-        return output_frames[:, :num_total_output_frames, :, :]
+                output_frames.append(self(None, mode="propagate"))
+            num_chunk_frames += 1
+            if num_chunk_frames == chunk_size or future_frame_idx == num_total_output_frames - 1:
+                yield torch.cat(output_frames[-num_chunk_frames:], dim=1)
+                num_chunk_frames = 0
+                output_frames = [frame.detach() for frame in output_frames[-self.num_input_frames:]]
+                self.h0 = self.h0.detach()
+                self.c0 = self.c0.detach()
+
+    def rollout_step(self, input_frames):
+        return self.forward_many(input_frames, self.get_num_output_frames())
+
+    def get_future_frames_refeed(self, input_frames, num_total_output_frames):
+        return rollout(self.rollout_step, input_frames, num_total_output_frames, self.get_num_input_frames())
 
     def get_future_frames(self, input_frames, num_total_output_frames, refeed):
         if refeed:
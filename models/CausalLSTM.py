@@ -3,6 +3,7 @@
 # It is part of PredRNN and PredRNN++
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 
 
 class CausalLSTMCell(nn.Module):
@@ -20,6 +21,10 @@ class CausalLSTMCell(nn.Module):
         self.width = seq_shape[2]
         # self.layer_norm = tln
         self._forget_bias = forget_bias
+        # Off runs the h, c and m convolutions separately, as a reference for the fused gates
+        self.fuse_gates = True
+        self._fused_key = None
+        self._fused = None
 
         ###hidden state has similar spatial struture as inputs, we simply concatenate them on the feature dimension
         self.conv_h = nn.Conv2d(in_channels=self.num_hidden,
@@ -56,22 +61,48 @@ class CausalLSTMCell(nn.Module):
                                   stride=1,
                                   padding=0)
 
+    def _bias(self, conv):
+        # The convolution of a zero state is its bias
+        return conv.bias.view(1, -1, 1, 1)
+
+    def _fused_weights(self):
+        """
+        Weight and bias of the grouped convolution over cat(h, c, m), whose groups are the i, g, f gates of h
+        and the gates of c and m (3 x 3 gates, no padding). Without grad they are cached until a parameter changes
+        """
+        # With grad the concatenation has to be part of the graph of every step
+        if torch.is_grad_enabled():
+            return self._cat_fused_weights()
+        params = (self.conv_h.weight, self.conv_h.bias, self.conv_c.weight, self.conv_c.bias, self.conv_m.weight, self.conv_m.bias)
+        key = tuple((id(p), p.data_ptr(), p._version) for p in params)
+        if key != self._fused_key:
+            self._fused = self._cat_fused_weights()
+            self._fused_key = key
+        return self._fused
+
+    def _cat_fused_weights(self):
+        igf = 3 * self.num_hidden
+        return (torch.cat((self.conv_h.weight[:igf], self.conv_c.weight, self.conv_m.weight), dim=0),
+                torch.cat((self.conv_h.bias[:igf], self.conv_c.bias, self.conv_m.bias), dim=0))
+
+    def _state_gates(self, h, c, m):
+        """
+        Gate pre-activations of the h, c and m states: i_h, g_h, f_h, o_h, i_c, g_c, f_c, i_m, f_m, m_m.
+        When all three are present, everything but o_h runs as one grouped convolution. Zero (None) states
+        contribute their bias only
+        """
+        if self.fuse_gates and h is not None and c is not None and m is not None and self.num_hidden_in == self.num_hidden:
+            weight, bias = self._fused_weights()
+            gates = torch.chunk(F.conv2d(torch.cat((h, c, m), dim=1), weight, bias, padding=1, groups=3), 9, dim=1)
+            o_h = F.conv2d(h, self.conv_h.weight[3 * self.num_hidden:], self.conv_h.bias[3 * self.num_hidden:], padding=1)
+            return gates[:3] + (o_h,) + gates[3:]
+        h_cc = self.conv_h(h) if h is not None else self._bias(self.conv_h)
+        c_cc = self.conv_c(c) if c is not None else self._bias(self.conv_c)
+        m_cc = self.conv_m(m) if m is not None else self._bias(self.conv_m)
+        return torch.chunk(h_cc, 4, dim=1) + torch.chunk(c_cc, 3, dim=1) + torch.chunk(m_cc, 3, dim=1)
+
     def forward(self, x, h, c, m):
-        batch_size = x.size(0)
-        if h is None:
-            h = torch.zeros([batch_size, self.num_hidden, self.height, self.width]).to(self.device)
-        if c is None:
-            c = torch.zeros([batch_size, self.num_hidden, self.height, self.width]).to(self.device)
-        if m is None:
-            m = torch.zeros([batch_size, self.num_hidden_in, self.height, self.width]).to(self.device)
-
-        h_cc = self.conv_h(h)
-        c_cc = self.conv_c(c)
-        m_cc = self.conv_m(m)
-
-        i_h, g_h, f_h, o_h = torch.chunk(h_cc, 4, dim=1)
-        i_c, g_c, f_c = torch.chunk(c_cc, 3, dim=1)
-        i_m, f_m, m_m = torch.chunk(m_cc, 3, dim=1)
+        i_h, g_h, f_h, o_h, i_c, g_c, f_c, i_m, f_m, m_m = self._state_gates(h, c, m)
 
         if x is None:
             i = torch.sigmoid(i_h + i_c)
@@ -85,7 +116,7 @@ class CausalLSTMCell(nn.Module):
             f = torch.sigmoid(f_x + f_h + f_c + self._forget_bias)
             g = torch.tanh(g_x + g_h + g_c)
 
-        c_new = f * c + i * g
+        c_new = i * g if c is None else f * c + i * g
         # c2m = self.conv_h(c_new)
         i_c, g_c, f_c, o_c = torch.chunk(self.conv_h(c_new), 4, dim=1)
 
@@ -1,11 +1,19 @@
 from torch import nn
 import torch
+import torch.nn.functional as F
 from collections import OrderedDict
-from utils.helper_functions import convert_SBCHW_to_BSHW, convert_BSHW_to_SBCHW
+from functools import partial
+from .checkpointing import checkpoint_steps
+from .rollout import rollout
 
 
 class ConvLSTMCell(nn.Module):
-    def __init__(self, input_channel, num_filter, b_h_w, kernel_size, stride=1, padding=1, device=None, seq_len=None, dilation=0):
+    """
+    ConvLSTM cell on batch-major sequences, B*S*C*H*W. The gates are a single convolution of [x, h]; its input half
+    is applied to all time steps at once and only the hidden half runs in the loop.
+    Zero states and missing inputs skip their convolutions. Any batch size and resolution are accepted.
+    """
+    def __init__(self, input_channel, num_filter, kernel_size, stride=1, padding=1, seq_len=None, dilation=1):
         super().__init__()
         self._conv = nn.Conv2d(in_channels=input_channel + num_filter,
                                out_channels=num_filter * 4,
@@ -13,51 +21,67 @@ class ConvLSTMCell(nn.Module):
                                stride=stride,
                                padding=padding,
                                dilation=dilation)
-        self._batch_size, self._state_height, self._state_width = b_h_w
-        self.Wci = torch.zeros(1, num_filter, self._state_height, self._state_width).to(device)
-        self.Wcf = torch.zeros(1, num_filter, self._state_height, self._state_width).to(device)
-        self.Wco = torch.zeros(1, num_filter, self._state_height, self._state_width).to(device)
-        # self.Wci.requires_grad = True
-        # self.Wcf.requires_grad = True
-        # self.Wco.requires_grad = True
         self._input_channel = input_channel
         self._num_filter = num_filter
-        self.device = device
         self.seq_len = seq_len
-    # inputs and states should not be all none
-    # inputs: S*B*C*H*W
+        self.checkpoint_every = 0
 
-    def forward(self, inputs=None, states=None, seq_len=None):
+    def _conv_part(self, x, weight, bias=None):
+        return F.conv2d(x, weight, bias, self._conv.stride, self._conv.padding, self._conv.dilation)
 
-        if states is None:
-            c = torch.zeros((inputs.size(1), self._num_filter, self._state_height,
-                            self._state_width), dtype=torch.float).to(self.device)
-            h = torch.zeros((inputs.size(1), self._num_filter, self._state_height,
-                             self._state_width), dtype=torch.float).to(self.device)
-        else:
-            h, c = states
-        if seq_len is None:
-            seq_len = self.seq_len
+    def _input_gates(self, inputs):
+        # The input half of the convolution for every time step in one batched call
+        batch_size, seq_len = inputs.size(0), inputs.size(1)
+        x = inputs.reshape(batch_size * seq_len, *inputs.shape[2:])
+        gates = self._conv_part(x, self._conv.weight[:, :self._input_channel], self._conv.bias)
+        return gates.view(batch_size, seq_len, *gates.shape[1:])
+
+    def _steps(self, h, c, inputs, seq_len):
+        input_gates = self._input_gates(inputs) if inputs is not None else None
+        bias = self._conv.bias.view(1, -1, 1, 1)
         outputs = []
-        # if inputs is not None:
         for index in range(seq_len):
-            if inputs is None:
-                x = torch.zeros((h.size(0), self._input_channel, self._state_height,
-                                self._state_width), dtype=torch.float).to(self.device)
+            if h is None:
+                conv_x = input_gates[:, index]
+            elif input_gates is None:
+                conv_x = self._conv_part(h, self._conv.weight[:, self._input_channel:]) + bias
             else:
-                x = inputs[index, ...]
-            cat_x = torch.cat([x, h], dim=1)
-            conv_x = self._conv(cat_x)
+                conv_x = input_gates[:, index] + self._conv_part(h, self._conv.weight[:, self._input_channel:])
 
             i, f, tmp_c, o = torch.chunk(conv_x, 4, dim=1)
 
-            i = torch.sigmoid(i + self.Wci * c)
-            f = torch.sigmoid(f + self.Wcf * c)
-            c = f * c + i * torch.tanh(tmp_c)
-            o = torch.sigmoid(o + self.Wco * c)
-            h = o * torch.tanh(c)
+            i = torch.sigmoid(i)
+            if c is None:
+                c = i * torch.tanh(tmp_c)
+            else:
+                c = torch.sigmoid(f) * c + i * torch.tanh(tmp_c)
+            h = torch.sigmoid(o) * torch.tanh(c)
             outputs.append(h)
-        return torch.stack(outputs), (h, c)
+        return torch.stack(outputs, dim=1), h, c
+
+    # inputs: B*S*C*H*W, states None for zero states
+    def forward(self, inputs=None, states=None, seq_len=None):
+        assert inputs is not None or states is not None
+        h, c = (None, None) if states is None else states
+        if seq_len is None:
+            seq_len = self.seq_len
+        if self.checkpoint_every == 0 or not (self.training and torch.is_grad_enabled()):
+            outputs, h, c = self._steps(h, c, inputs, seq_len)
+            return outputs, (h, c)
+
+        # Activation checkpointing: only the states between segments of checkpoint_every steps are kept for backward
+        outputs = []
+        for start in range(0, seq_len, self.checkpoint_every):
+            num_steps = min(self.checkpoint_every, seq_len - start)
+            if h is None:
+                # The first segment starts from zero states, it has no state tensors to pass through the checkpoint
+                segment_outputs, h, c = checkpoint_steps(partial(self._steps, None, None, seq_len=num_steps), inputs[:, start:start + num_steps])
+            elif inputs is None:
+                segment_outputs, h, c = checkpoint_steps(partial(self._steps, inputs=None, seq_len=num_steps), h, c)
+            else:
+                segment_outputs, h, c = checkpoint_steps(partial(self._steps, seq_len=num_steps), h, c, inputs[:, start:start + num_steps])
+            outputs.append(segment_outputs)
+        return torch.cat(outputs, dim=1), (h, c)
 
 
 class Encoder(nn.Module):
@@ -71,23 +95,29 @@ class Encoder(nn.Module):
             setattr(self, 'stage' + str(index), make_layers(params))
             setattr(self, 'rnn' + str(index), rnn)
 
-    def forward_by_stage(self, input, subnet, rnn, num_input_frames):
-        seq_number, batch_size, input_channel, height, width = input.size()
+    def forward_by_stage(self, input, subnet, rnn, num_input_frames, state=None):
+        batch_size, seq_number, input_channel, height, width = input.size()
         input = torch.reshape(input, (-1, input_channel, height, width))
         input = subnet(input)
-        input = torch.reshape(input, (seq_number, batch_size, input.size(1), input.size(2), input.size(3)))
-        outputs_stage, state_stage = rnn(input, None, num_input_frames)
+        input = torch.reshape(input, (batch_size, seq_number, input.size(1), input.size(2), input.size(3)))
+        outputs_stage, state_stage = rnn(input, state, num_input_frames)
 
         return outputs_stage, state_stage
 
-    # input: 5D S*B*I*H*W
+    def forward_with_states(self, input, hidden_states, num_input_frames):
+        """
+        Continues the encoding from hidden_states, None for every stage starts from zero states
+        """
+        new_hidden_states = []
+        for i in range(1, self.blocks + 1):
+            input, state_stage = self.forward_by_stage(input, getattr(self, 'stage' + str(i)), getattr(self, 'rnn' + str(i)), num_input_frames, hidden_states[i - 1])
+            new_hidden_states.append(state_stage)
+        return tuple(new_hidden_states)
+
+    # input: 5D B*S*I*H*W
     def forward(self, input, num_input_frames):
-        hidden_states = []
         # logging.debug(input.size())
-        for i in range(1, self.blocks + 1):
-            input, state_stage = self.forward_by_stage(input, getattr(self, 'stage' + str(i)), getattr(self, 'rnn' + str(i)), num_input_frames)
-            hidden_states.append(state_stage)
-        return tuple(hidden_states)
+        return self.forward_with_states(input, [None] * self.blocks, num_input_frames)
 
 
 class Forecaster(nn.Module):
@@ -103,21 +133,26 @@ class Forecaster(nn.Module):
 
     def forward_by_stage(self, input, state, subnet, rnn, num_output_frames):
         input, state_stage = rnn(input, state, num_output_frames)
-        seq_number, batch_size, input_channel, height, width = input.size()
+        batch_size, seq_number, input_channel, height, width = input.size()
         input = torch.reshape(input, (-1, input_channel, height, width))
         input = subnet(input)
-        input = torch.reshape(input, (seq_number, batch_size, input.size(1), input.size(2), input.size(3)))
+        input = torch.reshape(input, (batch_size, seq_number, input.size(1), input.size(2), input.size(3)))
+
+        return input, state_stage
 
-        return input
 
-        # input: 5D S*B*I*H*W
+    def forward_with_states(self, hidden_states, num_output_frames):
+        """
+        Returns the output and the recurrent states after num_output_frames, so that the forecast can be continued
+        """
+        hidden_states = list(hidden_states)
+        input = None
+        for i in list(range(1, self.blocks + 1))[::-1]:
+            input, hidden_states[i - 1] = self.forward_by_stage(input, hidden_states[i - 1], getattr(self, 'stage' + str(i)), getattr(self, 'rnn' + str(i)), num_output_frames)
+        return input, hidden_states
 
     def forward(self, hidden_states, num_output_frames):
-        input = self.forward_by_stage(None, hidden_states[-1], getattr(self, 'stage3'),
-                                      getattr(self, 'rnn3'), num_output_frames)
-        for i in list(range(1, self.blocks))[::-1]:
-            input = self.forward_by_stage(input, hidden_states[i - 1], getattr(self, 'stage' + str(i)), getattr(self, 'rnn' + str(i)), num_output_frames)
-        return input
+        return self.forward_with_states(hidden_states, num_output_frames)[0]
 
 
 class EncoderForecaster(nn.Module):
@@ -128,30 +163,56 @@ class EncoderForecaster(nn.Module):
         self.device = device
 
     def forward(self, input, num_output_frames):
-        input = convert_BSHW_to_SBCHW(input)
-        state = self.encoder(input, self.get_num_input_frames())
+        # B*S*H*W frames are B*S*1*H*W sequences without a copy
+        state = self.encoder(input.unsqueeze(2), self.get_num_input_frames())
         output = self.forecaster(state, num_output_frames)
-        return convert_SBCHW_to_BSHW(output)
+        return output.squeeze(2)
 
     def get_num_input_frames(self):
         return self.encoder.rnn1.seq_len
 
+    def set_activation_checkpointing(self, every):
+        for module in self.modules():
+            if isinstance(module, ConvLSTMCell):
+                module.checkpoint_every = every
+
     def get_num_output_frames(self):
         return self.forecaster.rnn3.seq_len
 
+    def get_future_frames_chunks(self, input_frames, num_total_output_frames, chunk_size):
+        """
+        Truncated backpropagation through time: yields the predictions in chunks of chunk_size frames
+        and detaches the forecaster states between the chunks
+        """
+        hidden_states = self.encoder(input_frames.unsqueeze(2), self.get_num_input_frames())
+        for chunk_start in range(0, num_total_output_frames, chunk_size):
+            num_chunk_frames = min(chunk_size, num_total_output_frames - chunk_start)
+            output, hidden_states = self.forecaster.forward_with_states(hidden_states, num_chunk_frames)
+            yield output.squeeze(2)
+            hidden_states = [(h.detach(), c.detach()) for h, c in hidden_states]
+
+    def init_state(self, batch_size):
+        return {'encoder': [None] * self.encoder.blocks}
+
+    def observe(self, state, frame):
+        """
+        Encodes one more frame (B x 1 x H x W) on top of the encoder states
+        """
+        state['encoder'] = self.encoder.forward_with_states(frame.unsqueeze(2), state['encoder'], 1)
+        return state
+
+    def predict(self, state, num_frames):
+        # The forecaster starts from the encoder states, which are left as they are
+        if state['encoder'][0] is None:
+            raise ValueError('No frames observed yet')
+        output, _ = self.forecaster.forward_with_states(state['encoder'], num_frames)
+        return output.squeeze(2)
+
+    def rollout_step(self, input_frames):
+        return self(input_frames, self.get_num_output_frames())
+
     def get_future_frames_refeed(self, input_frames, num_total_output_frames):
-        num_input_frames = self.get_num_input_frames()
-        num_output_frames = self.get_num_output_frames()
-        output_frames = self(input_frames, num_output_frames)
-
-        while output_frames.size(1) < num_total_output_frames:
-            if output_frames.size(1) < num_input_frames:
-                keep_from_input = num_input_frames - output_frames.size(1)
-                input_frames = torch.cat((input_frames[:, -keep_from_input:, :, :], output_frames), dim=1)
-            else:
-                input_frames = output_frames[:, -num_input_frames:, :, :].clone()
-            output_frames = torch.cat((output_frames, self(input_frames, num_output_frames)), dim=1)
-        return output_frames[:, :num_total_output_frames, :, :]
+        return rollout(self.rollout_step, input_frames, num_total_output_frames, self.get_num_input_frames())
 
     def get_future_frames(self, input_frames, num_total_output_frames, refeed):
         if refeed:
@@ -160,19 +221,16 @@ class EncoderForecaster(nn.Module):
             return self(input_frames, num_total_output_frames)
 
 
-def get_convlstm_model(num_input_frames, num_output_frames, batch_size, device, dilation=1, padding=1):    # Define encoder #
+def get_convlstm_model(num_input_frames, num_output_frames, device, dilation=1, padding=1):    # Define encoder #
     encoder_architecture = [
         # in_channels, out_channels, kernel_size, stride, padding
         [OrderedDict({'conv1_leaky_1': [1, 8, 3, 2, 1]}),
          OrderedDict({'conv2_leaky_1': [64, 192, 3, 2, 1]}),
          OrderedDict({'conv3_leaky_1': [192, 192, 3, 2, 1]})],
 
-        [ConvLSTMCell(input_channel=8, num_filter=64, b_h_w=(batch_size, 64, 64),
-                      kernel_size=3, stride=1, padding=padding, device=device, seq_len=num_input_frames, dilation=dilation),
-         ConvLSTMCell(input_channel=192, num_filter=192, b_h_w=(batch_size, 32, 32),
-                      kernel_size=3, stride=1, padding=padding, device=device, seq_len=num_input_frames, dilation=dilation),
-         ConvLSTMCell(input_channel=192, num_filter=192, b_h_w=(batch_size, 16, 16),
-                      kernel_size=3, stride=1, padding=padding, device=device, seq_len=num_input_frames, dilation=dilation)]
+        [ConvLSTMCell(input_channel=8, num_filter=64, kernel_size=3, stride=1, padding=padding, seq_len=num_input_frames, dilation=dilation),
+         ConvLSTMCell(input_channel=192, num_filter=192, kernel_size=3, stride=1, padding=padding, seq_len=num_input_frames, dilation=dilation),
+         ConvLSTMCell(input_channel=192, num_filter=192, kernel_size=3, stride=1, padding=padding, seq_len=num_input_frames, dilation=dilation)]
     ]
 
     forecaster_architecture = [
@@ -182,16 +240,13 @@ def get_convlstm_model(num_input_frames, num_output_frames, batch_size, device,
                       'conv3_leaky_2': [8, 8, 3, 1, 1],
                       'conv3_3': [8, 1, 1, 1, 0]}), ],
 
-        [ConvLSTMCell(input_channel=192, num_filter=192, b_h_w=(batch_size, 16, 16),
-                      kernel_size=3, stride=1, padding=padding, device=device, seq_len=num_output_frames, dilation=dilation),
-         ConvLSTMCell(input_channel=192, num_filter=192, b_h_w=(batch_size, 32, 32),
-                      kernel_size=3, stride=1, padding=padding, device=device, seq_len=num_output_frames, dilation=dilation),
-         ConvLSTMCell(input_channel=64, num_filter=64, b_h_w=(batch_size, 64, 64),
-                      kernel_size=3, stride=1, padding=padding, device=device, seq_len=num_output_frames, dilation=dilation)]
+        [ConvLSTMCell(input_channel=192, num_filter=192, kernel_size=3, stride=1, padding=padding, seq_len=num_output_frames, dilation=dilation),
+         ConvLSTMCell(input_channel=192, num_filter=192, kernel_size=3, stride=1, padding=padding, seq_len=num_output_frames, dilation=dilation),
+         ConvLSTMCell(input_channel=64, num_filter=64, kernel_size=3, stride=1, padding=padding, seq_len=num_output_frames, dilation=dilation)]
     ]
 
-    encoder = Encoder(encoder_architecture[0], encoder_architecture[1]).to(device)
-    forecaster = Forecaster(forecaster_architecture[0], forecaster_architecture[1]).to(device)
+    encoder = Encoder(encoder_architecture[0], encoder_architecture[1])
+    forecaster = Forecaster(forecaster_architecture[0], forecaster_architecture[1])
     return EncoderForecaster(encoder, forecaster, device)
 
 
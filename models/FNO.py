@@ -0,0 +1,102 @@
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from models.rollout import rollout
+
+
+def compl_mul2d(a, b):
+    # (batch, in, x, y), (in, out, x, y) -> (batch, out, x, y)
+    return torch.einsum("bixy,ioxy->boxy", a, b)
+
+
+class SpectralConv2d(nn.Module):
+    """
+    Multiplies the lowest modes1 x modes2 Fourier modes of the input by learned complex weights and discards the rest.
+    Each output pixel depends on the whole frame at a cost of O(N log N) per channel.
+    """
+    def __init__(self, in_channels, out_channels, modes1, modes2):
+        super(SpectralConv2d, self).__init__()
+        self.in_channels = in_channels
+        self.out_channels = out_channels
+        self.modes1 = modes1
+        self.modes2 = modes2
+        scale = 1 / (in_channels * out_channels)
+        # Real and imaginary parts in the last dimension. Positive and negative frequencies along x
+        self.weights1 = nn.Parameter(scale * torch.rand(in_channels, out_channels, modes1, modes2, 2))
+        self.weights2 = nn.Parameter(scale * torch.rand(in_channels, out_channels, modes1, modes2, 2))
+
+    def _mix(self, x_ft, modes1, modes2):
+        out_ft = x_ft.new_zeros(x_ft.size(0), self.out_channels, x_ft.size(2), x_ft.size(3))
+        weights1 = torch.view_as_complex(self.weights1[:, :, :modes1, :modes2].contiguous())
+        weights2 = torch.view_as_complex(self.weights2[:, :, :modes1, :modes2].contiguous())
+        out_ft[:, :, :modes1, :modes2] = compl_mul2d(x_ft[:, :, :modes1, :modes2], weights1)
+        out_ft[:, :, -modes1:, :modes2] = compl_mul2d(x_ft[:, :, -modes1:, :modes2], weights2)
+        return out_ft
+
+    def _mix_real(self, x_ft, modes1, modes2):
+        # Older torch without complex tensors: x_ft holds the real and imaginary parts in the last dimension
+        def mul(a, w):
+            w = w[:, :, :modes1, :modes2]
+            real = compl_mul2d(a[..., 0], w[..., 0]) - compl_mul2d(a[..., 1], w[..., 1])
+            imag = compl_mul2d(a[..., 0], w[..., 1]) + compl_mul2d(a[..., 1], w[..., 0])
+            return torch.stack((real, imag), dim=-1)
+        out_ft = x_ft.new_zeros(x_ft.size(0), self.out_channels, x_ft.size(2), x_ft.size(3), 2)
+        out_ft[:, :, :modes1, :modes2] = mul(x_ft[:, :, :modes1, :modes2], self.weights1)
+        out_ft[:, :, -modes1:, :modes2] = mul(x_ft[:, :, -modes1:, :modes2], self.weights2)
+        return out_ft
+
+    def forward(self, x):
+        height, width = x.size(-2), x.size(-1)
+        # Frames smaller than the training resolution have fewer modes
+        modes1 = min(self.modes1, height // 2)
+        modes2 = min(self.modes2, width // 2 + 1)
+        if hasattr(torch, 'fft') and hasattr(torch.fft, 'rfft2'):
+            x_ft = torch.fft.rfft2(x)
+            return torch.fft.irfft2(self._mix(x_ft, modes1, modes2), s=(height, width))
+        x_ft = torch.rfft(x, 2, onesided=True)
+        return torch.irfft(self._mix_real(x_ft, modes1, modes2), 2, onesided=True, signal_sizes=(height, width))
+
+
+class FNO(nn.Module):
+    """
+    Fourier neural operator. The input frames and the pixel coordinates are lifted to width channels,
+    mixed by Fourier layers (spectral convolution plus a 1x1 convolution) and projected to the output frames.
+    The weights do not depend on the resolution, so a model trained at 128x128 can predict larger or smaller frames.
+    """
+    def __init__(self, num_input_frames, num_output_frames, modes=12, width=32, num_layers=4):
+        super(FNO, self).__init__()
+        self.num_input_frames = num_input_frames
+        self.num_output_frames = num_output_frames
+        self.lift = nn.Conv2d(num_input_frames + 2, width, 1)
+        self.spectral_convs = nn.ModuleList([SpectralConv2d(width, width, modes, modes) for _ in range(num_layers)])
+        self.pointwise_convs = nn.ModuleList([nn.Conv2d(width, width, 1) for _ in range(num_layers)])
+        self.project1 = nn.Conv2d(width, 128, 1)
+        self.project2 = nn.Conv2d(128, num_output_frames, 1)
+
+    def get_grid(self, x):
+        batch_size, _, height, width = x.size()
+        grid_y = torch.linspace(0, 1, height, device=x.device, dtype=x.dtype).view(1, 1, height, 1).expand(batch_size, 1, height, width)
+        grid_x = torch.linspace(0, 1, width, device=x.device, dtype=x.dtype).view(1, 1, 1, width).expand(batch_size, 1, height, width)
+        return torch.cat((grid_y, grid_x), dim=1)
+
+    def forward(self, x):
+        x = self.lift(torch.cat((x, self.get_grid(x)), dim=1))
+        for i, (spectral_conv, pointwise_conv) in enumerate(zip(self.spectral_convs, self.pointwise_convs)):
+            x = spectral_conv(x) + pointwise_conv(x)
+            if i < len(self.spectral_convs) - 1:
+                x = F.gelu(x)
+        x = F.gelu(self.project1(x))
+        return self.project2(x)
+
+    def rollout_step(self, input_frames):
+        return self(input_frames)
+
+    def get_future_frames(self, input_frames, num_total_output_frames, refeed):
+        # Like UNet and ResNet the predictions are always fed back, refeed only switches the mode of the RNNs
+        return rollout(self.rollout_step, input_frames, num_total_output_frames, self.get_num_input_frames())
+
+    def get_num_input_frames(self):
+        return self.num_input_frames
+
+    def get_num_output_frames(self):
+        return self.num_output_frames
@@ -33,9 +33,8 @@ class GHU(nn.Module):
         return torch.zeros([batch, num_features, height, width]).to(self.device)
 
     def forward(self, x, z):
-        if z is None:
-            z = self.init_state(x, self.num_features)
-        z_concat = self.conv_z(z)
+        # The convolution of a zero state is its bias
+        z_concat = self.conv_z(z) if z is not None else self.conv_z.bias.view(1, -1, 1, 1)
 
         x_concat = self.conv_x(x)
         # if self.layer_norm:
@@ -45,5 +44,5 @@ class GHU(nn.Module):
         p, u = torch.chunk(gates, 2, dim=1)
         p = torch.tanh(p)
         u = torch.sigmoid(u)
-        z_new = u * p + (1 - u) * z
+        z_new = u * p if z is None else u * p + (1 - u) * z
         return z_new
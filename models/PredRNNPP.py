@@ -4,8 +4,11 @@
 
 import torch
 import torch.nn as nn
+from models.rollout import rollout
+from functools import partial
 from .CausalLSTM import CausalLSTMCell
 from .GHU import GHU
+from .checkpointing import checkpoint_steps
 
 
 class PredRNNPP(nn.Module):
@@ -18,6 +21,7 @@ class PredRNNPP(nn.Module):
         self.device = device
         self.num_hidden = [64, 64, 64, 64]
         self.num_layers = len(self.num_hidden)
+        self.checkpoint_every = 0
 
         self.lstm = nn.ModuleList()
         self.output_channels = 1
@@ -58,22 +62,17 @@ class PredRNNPP(nn.Module):
     def get_num_input_frames(self):
         return self.num_input_frames
 
+    def set_activation_checkpointing(self, every):
+        self.checkpoint_every = every
+
     def get_num_output_frames(self):
         return self.num_output_frames
 
+    def rollout_step(self, input_frames):
+        return self(input_frames, self.get_num_output_frames())
+
     def get_future_frames_refeed(self, input_frames, num_total_output_frames):
-        num_input_frames = self.get_num_input_frames()
-        num_output_frames = self.get_num_output_frames()
-        output_frames = self(input_frames, num_output_frames)
-
-        while output_frames.size(1) < num_total_output_frames:
-            if output_frames.size(1) < num_input_frames:
-                keep_from_input = num_input_frames - output_frames.size(1)
-                input_frames = torch.cat((input_frames[:, -keep_from_input:, :, :], output_frames), dim=1)
-            else:
-                input_frames = output_frames[:, -num_input_frames:, :, :].clone()
-            output_frames = torch.cat((output_frames, self(input_frames, num_output_frames)), dim=1)
-        return output_frames[:, :num_total_output_frames, :, :]
+        return rollout(self.rollout_step, input_frames, num_total_output_frames, self.get_num_input_frames())
 
     def get_future_frames(self, input_frames, num_total_output_frames, refeed):
         if refeed:
@@ -81,8 +80,82 @@ class PredRNNPP(nn.Module):
         else:
             return self(input_frames, num_total_output_frames)
 
-    def forward(self, input_frames, num_output_frames):
+    def _encode(self, inputs):
+        inputs_ = self.conv(inputs)  # to 126x126
+        return self.pool(inputs_)  # to 31x31
+
+    def _encode_frames(self, input_frames):
+        # Encodes all frames (B x S x H x W) in one call, B x S x 8 x 31 x 31
+        batch_size, num_frames = input_frames.size(0), input_frames.size(1)
+        encoded = self._encode(input_frames.reshape(batch_size * num_frames, 1, input_frames.size(2), input_frames.size(3)))
+        return encoded.view(batch_size, num_frames, encoded.size(1), encoded.size(2), encoded.size(3))
+
+    def _step(self, inputs, hidden, cell, mem, z_t):
+        return self._step_encoded(self._encode(inputs), hidden, cell, mem, z_t)
+
+    def _step_encoded(self, inputs__, hidden, cell, mem, z_t):
+        # Runs a single time step on encoded inputs. hidden and cell are updated in place
+        # Causal LSTMs do not change dimensionality
+        hidden[0], cell[0], mem = self.lstm[0](inputs__, hidden[0], cell[0], mem)
+
+        if self.use_GHU:
+            z_t = self.ghu(hidden[0], z_t)
+        else:
+            z_t = hidden[0]
+        hidden[1], cell[1], mem = self.lstm[1](z_t, hidden[1], cell[1], mem)
+        for i in range(2, self.num_layers):
+            hidden[i], cell[i], mem = self.lstm[i](hidden[i - 1], hidden[i], cell[i], mem)
+
+        x_gen = self.deconv(hidden[self.num_layers - 1])  # back to 100x100
+        return x_gen, mem, z_t
+
+    def _segment(self, num_steps, use_inputs, inputs, x_gen, mem, z_t, *states):
+        # Runs num_steps time steps on tensors only, so that the segment can be checkpointed
+        hidden = list(states[:self.num_layers])
+        cell = list(states[self.num_layers:])
+        output = []
+        if use_inputs:
+            inputs = self._encode_frames(inputs)
+        for t in range(num_steps):
+            if use_inputs:
+                x_gen, mem, z_t = self._step_encoded(inputs[:, t], hidden, cell, mem, z_t)
+            else:
+                x_gen, mem, z_t = self._step(x_gen, hidden, cell, mem, z_t)
+            output.append(x_gen)
+        return (torch.cat(output, dim=1), x_gen, mem, z_t) + tuple(hidden) + tuple(cell)
+
+    def _forward_checkpointed(self, input_frames, num_output_frames):
+        """
+        Activation checkpointing: only the states between segments of checkpoint_every steps are kept for backward
+        """
         seq_length = self.num_input_frames + num_output_frames
+        cell = [None] * self.num_layers
+        hidden = [None] * self.num_layers
+        # The first step creates the states, afterwards every part of the state is a tensor
+        x_gen, mem, z_t = self._step(input_frames[:, 0, :, :].unsqueeze(1), hidden, cell, None, None)
+        output = []
+        t = 1
+        while t < seq_length:
+            use_inputs = t < self.num_input_frames
+            if use_inputs:
+                num_steps = min(self.checkpoint_every, self.num_input_frames - t)
+                inputs = input_frames[:, t:t + num_steps, :, :]
+            else:
+                num_steps = min(self.checkpoint_every, seq_length - t)
+                inputs = x_gen
+            segment = partial(self._segment, num_steps, use_inputs)
+            results = checkpoint_steps(segment, inputs, x_gen, mem, z_t, *(hidden + cell))
+            segment_output, x_gen, mem, z_t = results[:4]
+            hidden = list(results[4:4 + self.num_layers])
+            cell = list(results[4 + self.num_layers:])
+            if not use_inputs:
+                output.append(segment_output)
+            t += num_steps
+        return torch.cat(output, dim=1)
+
+    def forward(self, input_frames, num_output_frames):
+        if self.checkpoint_every > 0 and self.training and torch.is_grad_enabled():
+            return self._forward_checkpointed(input_frames, num_output_frames)
         cell = []
         hidden = []
         mem = None
@@ -90,33 +163,63 @@ class PredRNNPP(nn.Module):
         for i in range(self.num_layers):
             cell.append(None)
             hidden.append(None)
+        # x has shape B S H W. The known frames are encoded in one call
+        encoded = self._encode_frames(input_frames[:, :self.num_input_frames])
+        for t in range(self.num_input_frames):
+            x_gen, mem, z_t = self._step_encoded(encoded[:, t], hidden, cell, mem, z_t)
+
+        # The predictions are written into one preallocated tensor
+        output = x_gen.new_empty(x_gen.size(0), num_output_frames, x_gen.size(2), x_gen.size(3))
+        for t in range(num_output_frames):
+            x_gen, mem, z_t = self._step(x_gen, hidden, cell, mem, z_t)
+            output[:, t] = x_gen[:, 0]
+        return output
+
+    def init_state(self, batch_size):
+        return {'hidden': [None] * self.num_layers, 'cell': [None] * self.num_layers, 'mem': None, 'z_t': None, 'x_gen': None}
+
+    def observe(self, state, frame):
+        """
+        Runs one step on a new frame (B x 1 x H x W), the states are updated in place
+        """
+        state['x_gen'], state['mem'], state['z_t'] = self._step(frame, state['hidden'], state['cell'], state['mem'], state['z_t'])
+        return state
+
+    def predict(self, state, num_frames):
+        # Runs on copies of the states, so that more frames can be observed afterwards
+        if state['x_gen'] is None:
+            raise ValueError('No frames observed yet')
+        hidden, cell = list(state['hidden']), list(state['cell'])
+        x_gen, mem, z_t = state['x_gen'], state['mem'], state['z_t']
         output = []
+        for t in range(num_frames):
+            x_gen, mem, z_t = self._step(x_gen, hidden, cell, mem, z_t)
+            output.append(x_gen)
+        return torch.cat(output, dim=1)
+
+    def get_future_frames_chunks(self, input_frames, num_total_output_frames, chunk_size):
+        """
+        Truncated backpropagation through time: yields the predictions in chunks of chunk_size frames
+        and detaches the recurrent state between the chunks
+        """
+        cell = [None] * self.num_layers
+        hidden = [None] * self.num_layers
+        mem = None
+        z_t = None
         x_gen = None
-        # x has shape B S H W
-        for t in range(seq_length):
+        encoded = self._encode_frames(input_frames[:, :self.num_input_frames])
+        for t in range(self.num_input_frames):
+            x_gen, mem, z_t = self._step_encoded(encoded[:, t], hidden, cell, mem, z_t)
 
-            if t < self.num_input_frames:
-                inputs = input_frames[:, t, :, :].unsqueeze(1)
-            else:
-                inputs = x_gen
-
-            inputs_ = self.conv(inputs)  # to 126x126
-            inputs__ = self.pool(inputs_)  # to 31x31
-            # Causal LSTMs do not change dimensionality
-            hidden[0], cell[0], mem = self.lstm[0].forward(inputs__, hidden[0], cell[0], mem)
-
-            if self.use_GHU:
-                z_t = self.ghu(hidden[0], z_t)
-            else:
-                z_t = hidden[0]
-            hidden[1], cell[1], mem = self.lstm[1](z_t, hidden[1], cell[1], mem)
-            for i in range(2, self.num_layers):
-                hidden[i], cell[i], mem = self.lstm[i](hidden[i - 1], hidden[i], cell[i], mem)
-
-            x_gen = self.deconv(hidden[self.num_layers - 1])  # back to 100x100
-            output.append(x_gen.squeeze())
-
-        output = torch.stack(output[self.num_input_frames:])
-        if input_frames.size(0) == 1:  # if batch size one
-            output = output.unsqueeze(1)
-        return output.permute(1, 0, 2, 3)
+        output = []
+        for t in range(num_total_output_frames):
+            x_gen, mem, z_t = self._step(x_gen, hidden, cell, mem, z_t)
+            output.append(x_gen)
+            if len(output) == chunk_size or t == num_total_output_frames - 1:
+                yield torch.cat(output, dim=1)
+                output = []
+                hidden = [h.detach() for h in hidden]
+                cell = [c.detach() for c in cell]
+                mem = mem.detach()
+                z_t = z_t.detach()
+                x_gen = x_gen.detach()
@@ -1,5 +1,6 @@
 import torch.nn as nn
-import torch
+from models.tiling import tiled_forward
+from models.rollout import rollout
 
 
 def conv3x3(in_planes, out_planes, stride=1, groups=1, dilation=1):
@@ -53,6 +54,8 @@ class BasicBlock(nn.Module):
 
 
 class ResNet(nn.Module):
+    tile_size = 0
+
     def __init__(self, num_input_frames, num_output_frames, block, layers, dilation=1, num_classes=1000, zero_init_residual=False, groups=1, width_per_group=64, replace_stride_with_dilation=None,
                  norm_layer=None):
         super(ResNet, self).__init__()
@@ -138,18 +141,21 @@ class ResNet(nn.Module):
         x = self.conv2(x)
         return x
 
+    def set_tiling(self, tile_size, overlap=32, tile_batch_size=16):
+        """
+        Frames larger than tile_size are predicted in overlapping tiles, so that memory scales with the tile size
+        """
+        self.tile_size = tile_size
+        self.tile_overlap = overlap
+        self.tile_batch_size = tile_batch_size
+
+    def rollout_step(self, input_frames):
+        if self.tile_size > 0:
+            return tiled_forward(self, input_frames, self.tile_size, self.tile_overlap, self.tile_batch_size)
+        return self(input_frames)
+
     def get_future_frames(self, input_frames, num_total_output_frames, refeed):
-        output_frames = self(input_frames)
-        num_input_frames = self.get_num_input_frames()
-
-        while output_frames.size(1) < num_total_output_frames:
-            if output_frames.size(1) < num_input_frames:
-                keep_from_input = num_input_frames - output_frames.size(1)
-                input_frames = torch.cat((input_frames[:, -keep_from_input:, :, :], output_frames), dim=1)
-            else:
-                input_frames = output_frames[:, -num_input_frames:, :, :].clone()
-            output_frames = torch.cat((output_frames, self(input_frames)), dim=1)
-        return output_frames[:, :num_total_output_frames, :, :]
+        return rollout(self.rollout_step, input_frames, num_total_output_frames, self.get_num_input_frames())
 
     def get_num_input_frames(self):
         return self.num_input_frames
@@ -1,5 +1,7 @@
 import torch
 import torch.nn as nn
+from models.tiling import tiled_forward
+from models.rollout import rollout
 
 def double_conv(in_channels, out_channels):
     return nn.Sequential(
@@ -11,6 +13,7 @@ def double_conv(in_channels, out_channels):
 
 
 class UNet(nn.Module):
+    tile_size = 0
 
     def __init__(self, num_input_frames, num_output_frames, isize):
         super().__init__()
@@ -22,9 +25,8 @@ class UNet(nn.Module):
         self.dconv_down4 = double_conv(isize*4, isize*8)
 
         self.maxpool = nn.MaxPool2d(2)
-        # self.upsample = nn.Upsample(scale_factor=2, mode='bilinear', align_corners=True)
-
-        self.upsample = lambda x: torch.nn.functional.interpolate(x, mode='bilinear', scale_factor=2, align_corners=True)
+        # A module instead of a lambda so that the model can be scripted and compiled
+        self.upsample = nn.Upsample(scale_factor=2, mode='bilinear', align_corners=True)
 
         self.dconv_up3 = double_conv(isize*4 + isize*8, isize*4)
         self.dconv_up2 = double_conv(isize*2 + isize*4, isize*2)
@@ -61,18 +63,23 @@ class UNet(nn.Module):
 
         return out
 
+    def set_tiling(self, tile_size, overlap=32, tile_batch_size=16):
+        """
+        Frames larger than tile_size are predicted in overlapping tiles, so that memory scales with the tile size
+        """
+        if tile_size % 8 != 0:
+            raise ValueError('UNet tile size must be a multiple of 8, got %d' % tile_size)
+        self.tile_size = tile_size
+        self.tile_overlap = overlap
+        self.tile_batch_size = tile_batch_size
+
+    def rollout_step(self, input_frames):
+        if self.tile_size > 0:
+            return tiled_forward(self, input_frames, self.tile_size, self.tile_overlap, self.tile_batch_size)
+        return self(input_frames)
+
     def get_future_frames(self, input_frames, num_total_output_frames, refeed):
-        output_frames = self(input_frames)
-        num_input_frames = self.get_num_input_frames()
-
-        while output_frames.size(1) < num_total_output_frames:
-            if output_frames.size(1) < num_input_frames:
-                keep_from_input = num_input_frames - output_frames.size(1)
-                input_frames = torch.cat((input_frames[:, -keep_from_input:, :, :], output_frames), dim=1)
-            else:
-                input_frames = output_frames[:, -num_input_frames:, :, :].clone()
-            output_frames = torch.cat((output_frames, self(input_frames)), dim=1)
-        return output_frames[:, :num_total_output_frames, :, :]
+        return rollout(self.rollout_step, input_frames, num_total_output_frames, self.get_num_input_frames())
 
     def get_num_input_frames(self):
         return self.num_input_frames
@@ -0,0 +1,11 @@
+import inspect
+from torch.utils.checkpoint import checkpoint
+
+
+def checkpoint_steps(function, *args):
+    """
+    Runs function without keeping its intermediate activations, they are recomputed during the backward pass
+    """
+    if 'use_reentrant' in inspect.signature(checkpoint).parameters:
+        return checkpoint(function, *args, use_reentrant=False)
+    return checkpoint(function, *args)
@@ -0,0 +1,40 @@
+import torch.nn as nn
+
+DROPOUT_TYPES = (nn.Dropout, nn.Dropout2d, nn.Dropout3d, nn.AlphaDropout)
+
+
+class MCDropoutEnsemble(nn.Module):
+    """
+    Monte Carlo dropout: every sequence is repeated ensemble_size times along the batch dimension and rolled out once
+    with dropout active, so that all members run as one batch. Batch norm keeps its running statistics.
+    get_future_frames returns the mean of the members, get_future_frames_with_variance also their per-pixel variance
+    """
+    def __init__(self, model, ensemble_size):
+        super(MCDropoutEnsemble, self).__init__()
+        self.dropouts = [m for m in model.modules() if isinstance(m, DROPOUT_TYPES)]
+        if len(self.dropouts) == 0:
+            raise ValueError('%s has no dropout to sample from' % type(model).__name__)
+        self.model = model
+        self.ensemble_size = ensemble_size
+
+    def get_future_frames_with_variance(self, input_frames, num_total_output_frames, refeed):
+        batch_size = input_frames.size(0)
+        self.model.eval()
+        for dropout in self.dropouts:
+            dropout.train()
+        try:
+            members = self.model.get_future_frames(input_frames.repeat_interleave(self.ensemble_size, dim=0), num_total_output_frames, refeed)
+        finally:
+            for dropout in self.dropouts:
+                dropout.eval()
+        members = members.reshape(batch_size, self.ensemble_size, *members.shape[1:])
+        return members.mean(dim=1), members.var(dim=1)
+
+    def get_future_frames(self, input_frames, num_total_output_frames, refeed):
+        return self.get_future_frames_with_variance(input_frames, num_total_output_frames, refeed)[0]
+
+    def get_num_input_frames(self):
+        return self.model.get_num_input_frames()
+
+    def get_num_output_frames(self):
+        return self.model.get_num_output_frames()
@@ -0,0 +1,38 @@
+import torch
+
+
+def rollout(step, input_frames, num_total_output_frames, num_input_frames):
+    """
+    Autoregressive rollout shared by all models. step maps a window of num_input_frames frames to a block of
+    predicted frames, the last num_input_frames frames of inputs and predictions are fed back until
+    num_total_output_frames frames are predicted.
+    Without gradients the predictions are written into a preallocated buffer and every window is a view into it.
+    With gradients the windows cannot be views of a buffer that is written afterwards, so the blocks are kept
+    in a list and concatenated once.
+    """
+    if torch.is_grad_enabled():
+        return _rollout_with_grad(step, input_frames, num_total_output_frames, num_input_frames)
+    block = step(input_frames)
+    block_size = block.size(1)
+    num_blocks = -(-num_total_output_frames // block_size)
+    buffer = block.new_empty(block.size(0), num_input_frames + num_blocks * block_size, block.size(2), block.size(3))
+    buffer[:, :num_input_frames] = input_frames[:, -num_input_frames:]
+    buffer[:, num_input_frames:num_input_frames + block_size] = block
+    end = num_input_frames + block_size
+    while end - num_input_frames < num_total_output_frames:
+        block = step(buffer[:, end - num_input_frames:end])
+        buffer[:, end:end + block.size(1)] = block
+        end += block.size(1)
+    return buffer[:, num_input_frames:num_input_frames + num_total_output_frames]
+
+
+def _rollout_with_grad(step, input_frames, num_total_output_frames, num_input_frames):
+    blocks = [step(input_frames)]
+    num_frames = blocks[0].size(1)
+    window = input_frames
+    while num_frames < num_total_output_frames:
+        window = torch.cat((window, blocks[-1]), dim=1)[:, -num_input_frames:]
+        blocks.append(step(window))
+        num_frames += blocks[-1].size(1)
+    output_frames = torch.cat(blocks, dim=1) if len(blocks) > 1 else blocks[0]
+    return output_frames[:, :num_total_output_frames]
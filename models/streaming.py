@@ -0,0 +1,40 @@
+import torch
+
+
+class StreamingSession():
+    """
+    Keeps the recurrent state of a model between calls, so that every newly observed frame costs one step
+    instead of encoding the whole input window again. Works with the models that implement
+    init_state, observe and predict: ConvLSTM, PredRNN++ and AR_LSTM.
+    """
+    def __init__(self, model):
+        if not hasattr(model, 'init_state'):
+            raise ValueError('%s does not support streaming' % type(model).__name__)
+        self.model = model
+        self.state = None
+        self.num_observed = 0
+
+    def init_state(self, batch_size):
+        self.state = self.model.init_state(batch_size)
+        self.num_observed = 0
+
+    def observe(self, frame):
+        """
+        frame: B x H x W or B x 1 x H x W
+        """
+        if frame.dim() == 3:
+            frame = frame.unsqueeze(1)
+        if self.state is None:
+            self.init_state(frame.size(0))
+        self.model.eval()
+        with torch.no_grad():
+            self.state = self.model.observe(self.state, frame)
+        self.num_observed += 1
+
+    def predict(self, num_frames):
+        """
+        Returns the next num_frames frames, B x num_frames x H x W. The state is not changed
+        """
+        self.model.eval()
+        with torch.no_grad():
+            return self.model.predict(self.state, num_frames)
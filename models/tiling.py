@@ -0,0 +1,46 @@
+import torch
+
+
+def _tile_starts(size, tile_size, stride):
+    starts = list(range(0, size - tile_size, stride))
+    starts.append(size - tile_size)
+    return starts
+
+
+def _blend_ramp(tile_size, overlap):
+    # Linear ramp over the overlap. It never reaches zero, so pixels covered by a single tile keep their value
+    ramp = torch.ones(tile_size)
+    if overlap > 0:
+        edge = torch.arange(1, overlap + 1, dtype=torch.float) / (overlap + 1)
+        ramp[:overlap] = edge
+        ramp[-overlap:] = torch.min(ramp[-overlap:], edge.flip(0))
+    return ramp
+
+
+def tiled_forward(forward, input_frames, tile_size, overlap, tile_batch_size=16):
+    """
+    Runs forward on overlapping tiles of tile_size x tile_size and blends the outputs with weights that fall off
+    linearly over the overlap. forward must be fully convolutional, the overlap should cover its receptive field.
+    """
+    batch_size, _, height, width = input_frames.size()
+    if height <= tile_size and width <= tile_size:
+        return forward(input_frames)
+    tile_height, tile_width = min(tile_size, height), min(tile_size, width)
+    # A dimension smaller than the tile is covered by one tile, the overlap can be at most half a tile on each axis
+    overlap_y, overlap_x = min(overlap, tile_height // 2), min(overlap, tile_width // 2)
+    positions = [(y, x) for y in _tile_starts(height, tile_height, tile_height - overlap_y)
+                 for x in _tile_starts(width, tile_width, tile_width - overlap_x)]
+    window = (_blend_ramp(tile_height, overlap_y)[:, None] * _blend_ramp(tile_width, overlap_x)[None, :]).to(input_frames.device)
+
+    output_frames = None
+    weights = torch.zeros(height, width, device=input_frames.device)
+    for i in range(0, len(positions), tile_batch_size):
+        batch_positions = positions[i:i + tile_batch_size]
+        tiles = torch.cat([input_frames[:, :, y:y + tile_height, x:x + tile_width] for y, x in batch_positions], dim=0)
+        output_tiles = forward(tiles)
+        if output_frames is None:
+            output_frames = input_frames.new_zeros(batch_size, output_tiles.size(1), height, width)
+        for j, (y, x) in enumerate(batch_positions):
+            output_frames[:, :, y:y + tile_height, x:x + tile_width] += output_tiles[j * batch_size:(j + 1) * batch_size] * window
+            weights[y:y + tile_height, x:x + tile_width] += window
+    return output_frames / weights
@@ -0,0 +1,70 @@
+import logging
+import shutil
+import numpy as np
+import matplotlib.pyplot as plt
+from argparse import Namespace
+from utils.arg_extract import get_args
+from utils.experiment import Experiment, save_network, load_network
+from utils.experiment_evaluator import Evaluator
+from utils.experiment_runner import ExperimentRunner
+from utils.benchmark import count_flops, time_rollout
+from utils.pruning import PRUNABLE_MODELS, prune_model
+from utils.io import save, save_json, load_json
+
+plt.ioff()
+logging.basicConfig(format='%(message)s', level=logging.INFO)
+
+
+def measure(experiment, model, args):
+    evaluator = Evaluator(args.test_starting_point, 'Validation', experiment.normalizer)
+    evaluator.compute_experiment_metrics(model, False, experiment.dataloaders['val'], args.num_total_output_frames, experiment.device, debug=args.debug)
+    input_frames = next(iter(experiment.dataloaders['val']))[:1, :model.get_num_input_frames()].to(experiment.device)
+    return {'rmse': float(np.mean(evaluator.state['MSE_val'])),
+            'ssim': float(np.mean(evaluator.state['SSIM_val'])),
+            'flops': count_flops(model, input_frames),
+            'latency': time_rollout(model, input_frames, args.num_total_output_frames),
+            'parameters': int(sum(p.numel() for p in model.parameters()))}
+
+
+args_new = get_args()
+# Pruning needs the batch norms and the original layout
+args_new.optimize_inference = False
+experiment = Experiment(args_new)
+experiment.load_from_disk(test=True)
+if experiment.args.model_type not in PRUNABLE_MODELS:
+    raise Warning('Model %s cannot be pruned, only %s' % (experiment.args.model_type, PRUNABLE_MODELS))
+report = {'original': measure(experiment, experiment.model, args_new)}
+
+spec = prune_model(experiment.model, args_new.prune_amount, args_new.prune_method)
+logging.info('Pruned channels: %s' % spec)
+
+# The pruned model is saved as a new experiment, which reloads it through its pruning spec
+pruned_args = Namespace(**vars(args_new))
+pruned_args.experiment_name = '%s_pruned_%s_%s' % (args_new.experiment_name, args_new.prune_method, args_new.prune_amount)
+pruned_experiment = Experiment(pruned_args)
+shutil.copy(experiment.files['datasets'], pruned_experiment.files['datasets'])
+shutil.copy(experiment.files['logger'], pruned_experiment.files['logger'])
+metadata = load_json(experiment.files['metadata'] + '.json')
+metadata['args']['experiment_name'] = pruned_args.experiment_name
+metadata['model'] = '%s' % experiment.model
+save(metadata, pruned_experiment.files['metadata'])
+save_json(metadata, pruned_experiment.files['metadata'] + '.json')
+save_json(spec, pruned_experiment.files['pruning'])
+save_network(experiment.model, pruned_experiment.files['model_latest'])
+save_network(experiment.model, pruned_experiment.files['model_best'])
+
+pruned_args.num_epochs = experiment.logger.get_last_epoch() + 1 + args_new.prune_finetune_epochs
+pruned_experiment.load_from_disk(test=False)
+experiment_runner = ExperimentRunner(pruned_experiment)
+experiment_runner.best_val_model_loss = np.inf  # the loss of the unpruned model is not a reference
+experiment_runner.run_experiment()
+
+pruned_model = load_network(pruned_experiment.model, pruned_experiment.files['model_best'])
+report['pruned'] = measure(pruned_experiment, pruned_model, args_new)
+report['spec'] = spec
+for key in ['rmse', 'ssim', 'flops', 'latency', 'parameters']:
+    report['%s_ratio' % key] = report['pruned'][key] / report['original'][key]
+logging.info('RMSE %.4f -> %.4f, SSIM %.4f -> %.4f, FLOPs %.2fx, latency %.2fx' %
+             (report['original']['rmse'], report['pruned']['rmse'], report['original']['ssim'], report['pruned']['ssim'],
+              1 / report['flops_ratio'], 1 / report['latency_ratio']))
+save_json(report, pruned_experiment.files['pruning_report'])
@@ -0,0 +1,54 @@
+import logging
+import os
+import copy
+import torch
+import numpy as np
+import matplotlib.pyplot as plt
+from utils.arg_extract import get_args
+from utils.experiment import Experiment
+from utils.experiment_evaluator import Evaluator
+from utils.benchmark import time_rollout
+from utils.quantization import QUANTIZABLE_MODELS, quantize_model, save_quantized_model, load_quantized_model
+from utils.io import save_json
+
+plt.ioff()
+logging.basicConfig(format='%(message)s', level=logging.INFO)
+
+
+def measure(experiment, model, filename, args):
+    # Both versions run on the CPU, the quantized kernels have no GPU implementation
+    device = torch.device('cpu')
+    evaluator = Evaluator(args.test_starting_point, 'Validation', experiment.normalizer)
+    evaluator.compute_experiment_metrics(model, False, experiment.dataloaders['val'], args.num_total_output_frames, device, debug=args.debug)
+    input_frames = next(iter(experiment.dataloaders['val']))[:, :model.get_num_input_frames()]
+    return {'rmse': float(np.mean(evaluator.state['MSE_val'])),
+            'ssim': float(np.mean(evaluator.state['SSIM_val'])),
+            'latency': time_rollout(model, input_frames, args.num_total_output_frames),
+            'size': os.path.getsize(filename)}
+
+
+args_new = get_args()
+# FX fuses the batch norms itself and needs the original modules
+args_new.optimize_inference = False
+experiment = Experiment(args_new)
+experiment.load_from_disk(test=True)
+if experiment.args.model_type not in QUANTIZABLE_MODELS:
+    raise Warning('Model %s cannot be quantized, only %s' % (experiment.args.model_type, QUANTIZABLE_MODELS))
+
+float_model = experiment.model.cpu().eval()
+report = {'float': measure(experiment, float_model, experiment.files['model_best'], args_new)}
+
+# Calibrated on the validation split, the test split stays unseen
+quantized_model = quantize_model(copy.deepcopy(float_model), experiment.dataloaders['val'], args_new.num_total_output_frames,
+                                 args_new.calibration_batches, args_new.test_starting_point)
+save_quantized_model(quantized_model, experiment.files['model_int8'], experiment.args_new.image_size)
+# The saved artifact is evaluated, not the model in memory
+quantized_model = load_quantized_model(experiment.files['model_int8'], experiment.args.num_input_frames, experiment.args.num_output_frames)
+report['engine'] = torch.backends.quantized.engine
+report['int8'] = measure(experiment, quantized_model, experiment.files['model_int8'], args_new)
+for key in ['rmse', 'ssim', 'latency', 'size']:
+    report['%s_ratio' % key] = report['int8'][key] / report['float'][key]
+logging.info('RMSE %.4f -> %.4f, SSIM %.4f -> %.4f, latency %.2fx, size %.2fx' %
+             (report['float']['rmse'], report['int8']['rmse'], report['float']['ssim'], report['int8']['ssim'],
+              1 / report['latency_ratio'], 1 / report['size_ratio']))
+save_json(report, experiment.files['quantization_report'])
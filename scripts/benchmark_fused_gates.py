@@ -0,0 +1,29 @@
+"""
+Times the PredRNN++ rollout with the fused and the separate state convolutions of the causal LSTM cells and checks
+that both predict the same frames. Runs on a randomly initialized model, the weights do not change the timing
+"""
+import sys
+import os
+import argparse
+import logging
+import torch
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from models.PredRNNPP import PredRNNPP
+from utils.benchmark import compare_fused_gates
+
+if __name__ == '__main__':
+    logging.basicConfig(format='%(message)s', level=logging.INFO)
+    parser = argparse.ArgumentParser(description='Benchmark the fused gates of the causal LSTM cells')
+    parser.add_argument('--batch_size', type=int, default=8)
+    parser.add_argument('--image_size', type=int, default=128)
+    parser.add_argument('--num_input_frames', type=int, default=5)
+    parser.add_argument('--num_total_output_frames', type=int, default=20)
+    parser.add_argument('--repeats', type=int, default=5)
+    args = parser.parse_args()
+
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    model = PredRNNPP(args.num_input_frames, args.num_total_output_frames, device).to(device)
+    input_frames = torch.rand(args.batch_size, args.num_input_frames, args.image_size, args.image_size, device=device)
+    report = compare_fused_gates(model, input_frames, args.num_total_output_frames, args.repeats)
+    logging.info('Unfused %.4fs, fused %.4fs (%.2fx), max error %.2e' %
+                 (report['unfused_time'], report['fused_time'], report['unfused_time'] / report['fused_time'], report['max_error']))
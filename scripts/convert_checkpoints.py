@@ -0,0 +1,43 @@
+"""
+Converts the saved models of experiments from the legacy torch serialization format (torch < 1.6) to the zip format,
+which Experiment.load_from_disk memory-maps instead of reading and copying. Files already in the zip format are skipped.
+Needs torch >= 1.6.
+"""
+import sys
+import os
+import argparse
+import logging
+import zipfile
+import torch
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils.io import get_experiment_dir
+
+MODEL_FILES = ['model_best.pt', 'model_latest.pt']
+
+
+def convert(filename):
+    if zipfile.is_zipfile(filename):
+        return False
+    state_dict = torch.load(filename, map_location='cpu')
+    # Write to a temporary file first so that an interrupted conversion never leaves a corrupt model
+    torch.save(state_dict, filename + '.tmp', _use_new_zipfile_serialization=True)
+    os.replace(filename + '.tmp', filename)
+    return True
+
+
+if __name__ == '__main__':
+    logging.basicConfig(format='%(message)s', level=logging.INFO)
+    parser = argparse.ArgumentParser(description='Convert saved models to the memory-mappable format')
+    parser.add_argument('--experiments', type=str, nargs='*', default=None, help='Names of the experiments to convert (default: all)')
+    args = parser.parse_args()
+
+    experiments_dir = os.path.dirname(get_experiment_dir(''))
+    exp_names = args.experiments if args.experiments is not None else sorted(os.listdir(experiments_dir))
+    num_converted = 0
+    for exp_name in exp_names:
+        for model_file in MODEL_FILES:
+            filename = os.path.join(get_experiment_dir(exp_name), 'models', model_file)
+            if os.path.isfile(filename) and convert(filename):
+                logging.info('Converted %s' % filename)
+                num_converted += 1
+    logging.info('Converted %d models' % num_converted)
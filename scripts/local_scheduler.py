@@ -0,0 +1,211 @@
+"""
+Runs the experiments of new_experiments.json (or experiment_pool.json) on the local machine instead of submitting
+them to Slurm. Jobs run concurrently as subprocesses, each pinned to its own cores and limited in address space.
+The queue is persisted so that the scheduler can be restarted: jobs that were running are continued from their
+last checkpoint, failed jobs are continued up to max_retries times without stopping the rest of the sweep.
+Jobs are started longest first (by their "time" field), which keeps the total wall time of the sweep close to optimal.
+"""
+import sys
+import os
+import argparse
+import json
+import logging
+import resource
+import subprocess
+import time
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils.arg_extract import str2bool
+from utils.io import get_experiment_dir
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+EXPERIMENT_NAME = '{model_type}_batch_{batch_size}_samples_{samples_per_sequence}_in_{num_input_frames}_out_{num_output_frames}_{normalizer_type}_lr_{learning_rate}_dataset_{dataset}_{time_readable}_patience_{scheduler_patience}_back_and_forth_{back_and_forth}'
+TRAIN_ARGS = "--experiment_name {exp_name} --model_type {model_type} --batch_size {batch_size} --num_epochs {num_epochs} --samples_per_sequence {samples_per_sequence} --num_input_frames {num_input_frames} --num_output_frames {num_output_frames} --learning_rate {learning_rate} --normalizer_type {normalizer_type} --dataset {dataset} --scheduler_patience {scheduler_patience} --back_and_forth {back_and_forth}"
+
+
+def load_experiments(filename):
+    with open(filename) as f:
+        text = f.read()
+    try:
+        return json.loads(text)
+    except ValueError:
+        # experiment_pool.json holds bare "name": {...} entries to copy into new_experiments.json
+        return json.loads('{' + text.strip().strip(',') + '}')
+
+
+def parse_time(slurm_time):
+    """
+    Slurm time D-HH:MM:SS to seconds
+    """
+    days, hours = slurm_time.split('-') if '-' in slurm_time else (0, slurm_time)
+    h, m, s = [int(x) for x in hours.split(':')]
+    return int(days) * 86400 + h * 3600 + m * 60 + s
+
+
+def experiment_started(exp_name):
+    return os.path.isfile(os.path.join(get_experiment_dir(exp_name), 'pickles', 'logger.json'))
+
+
+def create_job(name, script, args, exp_args, defaults):
+    return {'name': name,
+            'script': script,
+            'args': args,
+            'cores': int(exp_args.get('cores', defaults.cores_per_job)),
+            'memory': int(exp_args.get('memory', defaults.memory_per_job)),
+            'expected_time': parse_time(exp_args['time']) if 'time' in exp_args else 0,
+            'resource_plan': exp_args.get('resource_plan', defaults.resource_plan),
+            'status': 'pending',
+            'attempts': 0,
+            'returncode': None}
+
+
+def create_train_jobs(experiments, defaults):
+    jobs = []
+    for exp_args in experiments.values():
+        exp_name = EXPERIMENT_NAME.format(**exp_args)
+        args = TRAIN_ARGS.format(exp_name=exp_name, **exp_args).split()
+        if experiment_started(exp_name):
+            args += ['--continue_experiment', 'True']
+        jobs.append(create_job(exp_name, 'train_network.py', args, exp_args, defaults))
+    return jobs
+
+
+def create_continue_jobs(experiment_names, num_epochs, defaults):
+    return [create_job(exp_name, 'train_network.py', ['--experiment_name', exp_name, '--num_epochs', str(num_epochs), '--continue_experiment', 'True'], {}, defaults)
+            for exp_name in experiment_names]
+
+
+def create_test_jobs(experiment_names, defaults):
+    return [create_job('test_%s' % exp_name, 'test_network.py', ['--experiment_name', exp_name], {}, defaults)
+            for exp_name in experiment_names]
+
+
+class LocalScheduler():
+    def __init__(self, queue_file, log_dir, max_retries=1, poll_interval=10):
+        self.queue_file = queue_file
+        self.log_dir = log_dir
+        self.max_retries = max_retries
+        self.poll_interval = poll_interval
+        self.cores = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else list(range(os.cpu_count()))
+        self.free_cores = list(self.cores)
+        self.processes = {}
+        self.jobs = []
+        if os.path.isfile(queue_file):
+            with open(queue_file) as f:
+                self.jobs = json.load(f)
+            for job in self.jobs:
+                if job['status'] == 'running':
+                    # The scheduler was stopped while the job was running
+                    self._continue(job)
+        os.makedirs(log_dir, exist_ok=True)
+
+    def save(self):
+        with open(self.queue_file + '.tmp', 'w') as f:
+            json.dump(self.jobs, f, indent=2)
+        os.replace(self.queue_file + '.tmp', self.queue_file)
+
+    def add(self, jobs):
+        queued = set(job['name'] for job in self.jobs if job['status'] in ['pending', 'running'])
+        for job in jobs:
+            if job['name'] in queued:
+                logging.info('%s is already queued' % job['name'])
+            else:
+                self.jobs.append(job)
+        self.save()
+
+    def _continue(self, job):
+        job['status'] = 'pending'
+        if job['script'] == 'train_network.py' and '--continue_experiment' not in job['args']:
+            job['args'] += ['--continue_experiment', 'True']
+
+    def _fits(self, job, free_memory):
+        return job['cores'] <= len(self.free_cores) and (free_memory is None or job['memory'] <= free_memory)
+
+    def _start(self, job):
+        cores = self.free_cores[:job['cores']]
+        self.free_cores = self.free_cores[job['cores']:]
+        memory = job['memory'] * 2**20
+
+        def limit_resources():
+            os.sched_setaffinity(0, cores)
+            if memory > 0:
+                # Limits the address space, CUDA jobs reserve far more than they use and need memory 0
+                resource.setrlimit(resource.RLIMIT_AS, (memory, memory))
+
+        env = dict(os.environ, OMP_NUM_THREADS=str(len(cores)), MKL_NUM_THREADS=str(len(cores)))
+        command = [sys.executable, job['script']] + job['args'] + ['--num_workers', str(max(len(cores) - 1, 0)), '--resource_plan', job.get('resource_plan', 'auto')]
+        log_file = open(os.path.join(self.log_dir, '%s_%d.out' % (job['name'], job['attempts'])), 'w')
+        process = subprocess.Popen(command, cwd=ROOT_DIR, env=env, stdout=log_file, stderr=subprocess.STDOUT, preexec_fn=limit_resources)
+        self.processes[job['name']] = (process, cores, log_file, time.time())
+        job['status'] = 'running'
+        job['attempts'] += 1
+        job['cores_used'] = cores
+        logging.info('Started %s on cores %s' % (job['name'], cores))
+
+    def _finish(self, job, returncode):
+        process, cores, log_file, start_time = self.processes.pop(job['name'])
+        log_file.close()
+        self.free_cores = sorted(self.free_cores + cores)
+        job['returncode'] = returncode
+        job['elapsed_time'] = job.get('elapsed_time', 0) + time.time() - start_time
+        if returncode == 0:
+            job['status'] = 'done'
+            logging.info('Finished %s in %.0fs' % (job['name'], job['elapsed_time']))
+        elif job['attempts'] <= self.max_retries:
+            logging.warning('%s failed with code %d, continuing it from its last checkpoint' % (job['name'], returncode))
+            self._continue(job)
+        else:
+            job['status'] = 'failed'
+            logging.warning('%s failed with code %d after %d attempts' % (job['name'], returncode, job['attempts']))
+
+    def run(self, total_memory=0):
+        while True:
+            for job in self.jobs:
+                if job['name'] in self.processes:
+                    returncode = self.processes[job['name']][0].poll()
+                    if returncode is not None:
+                        self._finish(job, returncode)
+            used_memory = sum(job['memory'] for job in self.jobs if job['name'] in self.processes)
+            free_memory = total_memory - used_memory if total_memory > 0 else None
+            # Longest processing time first
+            pending = sorted([job for job in self.jobs if job['status'] == 'pending'], key=lambda job: -job['expected_time'])
+            for job in pending:
+                if self._fits(job, free_memory):
+                    self._start(job)
+                    if free_memory is not None:
+                        free_memory -= job['memory']
+                elif len(self.processes) == 0:
+                    logging.warning('%s needs %d cores and %dMB, more than the machine has' % (job['name'], job['cores'], job['memory']))
+                    job['status'] = 'failed'
+            self.save()
+            if len(self.processes) == 0 and not any(job['status'] == 'pending' for job in self.jobs):
+                break
+            time.sleep(self.poll_interval)
+        logging.info('Done: %d finished, %d failed' % (sum(job['status'] == 'done' for job in self.jobs), sum(job['status'] == 'failed' for job in self.jobs)))
+
+
+if __name__ == '__main__':
+    logging.basicConfig(format='%(message)s', level=logging.INFO)
+    parser = argparse.ArgumentParser(description='Local experiment scheduler')
+    parser.add_argument('--experiments', type=str, default=None, help='JSON file with the experiments to train, e.g. new_experiments.json')
+    parser.add_argument('--continue_experiments', type=str, nargs='*', default=[], help='Names of experiments to continue')
+    parser.add_argument('--test_experiments', type=str, nargs='*', default=[], help='Names of experiments to test')
+    parser.add_argument('--num_epochs', type=int, default=1000, help='Number of epochs of the continued experiments')
+    parser.add_argument('--cores_per_job', type=int, default=4, help='Cores per job, unless the experiment sets "cores"')
+    parser.add_argument('--memory_per_job', type=int, default=12000, help='Address space limit per job in MB, unless the experiment sets "memory" (0: no limit)')
+    parser.add_argument('--total_memory', type=int, default=0, help='Memory in MB the jobs can use together (0: no limit)')
+    parser.add_argument('--resource_plan', type=str, default='auto', help='Resource plan of the jobs within their cores, unless the experiment sets "resource_plan" [none, auto, measure]')
+    parser.add_argument('--max_retries', type=int, default=1, help='How often a failed job is continued from its last checkpoint')
+    parser.add_argument('--queue', type=str, default='queue.json', help='File the queue is persisted in')
+    parser.add_argument('--log_dir', type=str, default='logs', help='Directory for the output of the jobs')
+    parser.add_argument('--run', type=str2bool, default=True, help='Run the queue, or only add the jobs to it')
+    args = parser.parse_args()
+
+    scheduler = LocalScheduler(args.queue, args.log_dir, args.max_retries)
+    jobs = []
+    if args.experiments is not None:
+        jobs += create_train_jobs(load_experiments(args.experiments), args)
+    jobs += create_continue_jobs(args.continue_experiments, args.num_epochs, args)
+    jobs += create_test_jobs(args.test_experiments, args)
+    scheduler.add(jobs)
+    if args.run:
+        scheduler.run(args.total_memory)
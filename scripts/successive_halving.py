@@ -0,0 +1,90 @@
+"""
+Successive halving over a sweep of experiments. All configurations are trained for min_epochs, ranked by the best
+validation loss in their logger, and the best 1/eta are continued from their checkpoints for eta times as many epochs,
+until max_epochs. The state of the sweep is persisted so that it can be restarted at the rung it stopped.
+"""
+import sys
+import os
+import argparse
+import logging
+import math
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils.io import save_json, load_json, get_experiment_dir
+from utils.Logger import Logger
+from local_scheduler import LocalScheduler, EXPERIMENT_NAME, load_experiments, create_train_jobs, create_continue_jobs
+
+
+def get_budgets(min_epochs, max_epochs, eta):
+    budgets = []
+    budget = min_epochs
+    while budget < max_epochs:
+        budgets.append(budget)
+        budget *= eta
+    budgets.append(max_epochs)
+    return budgets
+
+
+def get_best_validation_loss(exp_name):
+    filename = os.path.join(get_experiment_dir(exp_name), 'pickles', 'logger.json')
+    if not os.path.isfile(filename):
+        return float('inf')
+    logger = Logger()
+    logger.load_from_json(filename)
+    return logger.get_best_val_loss()
+
+
+def run_rung(experiments, exp_names, rung, budget, args):
+    scheduler = LocalScheduler('%s_rung_%d.json' % (args.sweep_name, rung), args.log_dir, args.max_retries)
+    if rung == 0:
+        rung_experiments = {key: dict(exp_args, num_epochs=budget) for key, exp_args in experiments.items()}
+        scheduler.add(create_train_jobs(rung_experiments, args))
+    else:
+        scheduler.add(create_continue_jobs(exp_names, budget, args))
+    scheduler.run(args.total_memory)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(format='%(message)s', level=logging.INFO)
+    parser = argparse.ArgumentParser(description='Successive halving sweep')
+    parser.add_argument('--experiments', type=str, default='experiment_pool.json', help='JSON file with the configurations of the sweep')
+    parser.add_argument('--sweep_name', type=str, default='sweep', help='Prefix of the files the state of the sweep is kept in')
+    parser.add_argument('--min_epochs', type=int, default=5, help='Epochs every configuration is trained for')
+    parser.add_argument('--max_epochs', type=int, default=200, help='Epochs the best configurations are trained for')
+    parser.add_argument('--eta', type=int, default=3, help='Only the best 1/eta of the configurations are promoted to the next rung, which has eta times the epochs')
+    parser.add_argument('--cores_per_job', type=int, default=4, help='Cores per job, unless the experiment sets "cores"')
+    parser.add_argument('--memory_per_job', type=int, default=12000, help='Address space limit per job in MB, unless the experiment sets "memory" (0: no limit)')
+    parser.add_argument('--total_memory', type=int, default=0, help='Memory in MB the jobs can use together (0: no limit)')
+    parser.add_argument('--resource_plan', type=str, default='auto', help='Resource plan of the jobs within their cores, unless the experiment sets "resource_plan" [none, auto, measure]')
+    parser.add_argument('--max_retries', type=int, default=1, help='How often a failed job is continued from its last checkpoint')
+    parser.add_argument('--log_dir', type=str, default='logs', help='Directory for the output of the jobs')
+    args = parser.parse_args()
+
+    experiments = load_experiments(args.experiments)
+    state_file = '%s.json' % args.sweep_name
+    if os.path.isfile(state_file):
+        state = load_json(state_file)
+    else:
+        state = {'budgets': get_budgets(args.min_epochs, args.max_epochs, args.eta),
+                 'rung': 0,
+                 'exp_names': [EXPERIMENT_NAME.format(**exp_args) for exp_args in experiments.values()],
+                 'rungs': []}
+
+    while state['rung'] < len(state['budgets']):
+        rung, budget = state['rung'], state['budgets'][state['rung']]
+        logging.info('Rung %d: training %d configurations for %d epochs' % (rung, len(state['exp_names']), budget))
+        run_rung(experiments, state['exp_names'], rung, budget, args)
+
+        losses = {exp_name: get_best_validation_loss(exp_name) for exp_name in state['exp_names']}
+        ranking = sorted(state['exp_names'], key=lambda exp_name: losses[exp_name])
+        for position, exp_name in enumerate(ranking):
+            logging.info('%d. %s: %.5f' % (position + 1, exp_name, losses[exp_name]))
+        state['rungs'].append({'budget': budget, 'losses': losses})
+        state['exp_names'] = ranking[:max(1, int(math.ceil(len(ranking) / float(args.eta))))]
+        state['rung'] += 1
+        save_json(state, state_file)
+
+    logging.info('Best configuration: %s' % state['exp_names'][0])
+    previous_budgets = [0] + [rung['budget'] for rung in state['rungs'][:-1]]
+    sweep_epochs = sum(len(rung['losses']) * (rung['budget'] - previous) for rung, previous in zip(state['rungs'], previous_budgets))
+    full_epochs = len(state['rungs'][0]['losses']) * state['budgets'][-1]
+    logging.info('Trained %d epochs instead of %d (%.1fx less)' % (sweep_epochs, full_epochs, full_epochs / float(sweep_epochs)))
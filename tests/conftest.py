@@ -0,0 +1,33 @@
+import os
+import sys
+import pytest
+
+SEQUENCES = 7
+FRAMES = 30
+
+
+@pytest.fixture
+def experiment_args(tmp_path, monkeypatch):
+    """
+    Writes a config.ini with a small dataset of random frames and returns a function that parses command line
+    arguments like train_network.py. Experiment reads ../config.ini, so the tests run in a subfolder
+    """
+    import numpy as np
+    from PIL import Image
+    from utils.arg_extract import get_args
+    data_dir = tmp_path / 'data' / 'Training_Data'
+    rng = np.random.RandomState(0)
+    for sequence in range(SEQUENCES):
+        os.makedirs(str(data_dir / ('sequence_%d' % sequence)))
+        for frame in range(FRAMES):
+            image = Image.fromarray(rng.randint(0, 256, (32, 32)).astype(np.uint8))
+            image.save(str(data_dir / ('sequence_%d' % sequence) / ('%03d.png' % frame)))
+    (tmp_path / 'config.ini').write_text('[paths]\ndata = %s/\nexperiments = %s\n' %
+                                         (tmp_path / 'data', tmp_path / 'experiments'))
+    os.makedirs(str(tmp_path / 'work'))
+    monkeypatch.chdir(str(tmp_path / 'work'))
+
+    def parse(*argv):
+        monkeypatch.setattr(sys, 'argv', ['train_network.py'] + list(argv))
+        return get_args()
+    return parse
@@ -0,0 +1,18 @@
+import pytest
+
+pytest.importorskip('torch')
+pytest.importorskip('torchvision')
+from utils.experiment import Experiment, DEFAULT_IMAGE_SIZE
+from utils.batch_size_finder import BatchSizeFinder
+
+
+def test_find_batch_size_without_image_size(experiment_args):
+    # Like train_network.py --find_batch_size, which runs before create_new resolves the image size
+    args = experiment_args('--model_type', 'unet_small', '--experiment_name', 'finder', '--num_output_frames', '2',
+                           '--memory_budget', '100000', '--find_batch_size', 'true')
+    assert args.image_size is None
+    finder = BatchSizeFinder(Experiment(args), args.memory_budget, max_batch_size=2)
+    assert finder.image_size == DEFAULT_IMAGE_SIZE
+    report = finder.run()
+    assert report['max_batch_size'] == 2
+    assert report['image_size'] == DEFAULT_IMAGE_SIZE
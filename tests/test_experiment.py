@@ -0,0 +1,21 @@
+import pytest
+
+torch = pytest.importorskip('torch')
+pytest.importorskip('torchvision')
+from utils.experiment import Experiment, save_network
+
+
+def test_load_convlstm_for_testing(experiment_args):
+    argv = ['--model_type', 'convlstm', '--experiment_name', 'convlstm', '--num_workers', '0', '--optimize_inference', 'false']
+    experiment = Experiment(experiment_args(*argv))
+    experiment.create_new()
+    save_network(experiment.model, experiment.files['model_best'])
+    experiment.logger.record_epoch_losses(1.0, 1.0, 0)
+    experiment.logger.save_to_json(experiment.files['logger'])
+
+    loaded = Experiment(experiment_args(*argv))
+    loaded.load_from_disk(test=True)
+    state_dict = experiment.model.state_dict()
+    for name, tensor in loaded.model.state_dict().items():
+        assert tensor.device.type != 'meta', name
+        assert torch.equal(tensor.cpu(), state_dict[name].cpu()), name
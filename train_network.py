@@ -3,6 +3,8 @@ import logging
 from utils.arg_extract import get_args
 from utils.experiment_runner import ExperimentRunner
 from utils.experiment import Experiment
+from utils.batch_size_finder import BatchSizeFinder
+from utils.io import save_json
 # from utils.experiment_evaluator import evaluate_experiment
 
 plt.ioff()
@@ -11,6 +13,11 @@ logging.basicConfig(format='%(message)s', level=logging.INFO)
 args = get_args()
 experiment = Experiment(args)
 
+if args.find_batch_size:
+    report = BatchSizeFinder(experiment, args.memory_budget).run()
+    save_json(report, experiment.files['batch_size_report'])
+    exit()
+
 if args.continue_experiment:
     experiment.load_from_disk(test=False)
 else:
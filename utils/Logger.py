@@ -5,6 +5,9 @@ import numpy as np
 from utils.io import save_figure, save_json, load_json
 import os
 import time
+import random
+
+STAGE_RESERVOIR_SIZE = 1000
 
 
 class Logger():
@@ -18,8 +21,16 @@ class Logger():
                      'epoch_nr': [],
                      'batch_loss': [],
                      'batch_nr': [],
+                     'validation_subset_loss': [],
+                     'validation_subset_epoch_nr': [],
+                     'stage_times': [],
+                     'memory': [],
                      }
         self.start_time = time.time()
+        # Running aggregates of the stage times of the current epoch
+        self.stage_epoch = None
+        self.stage_stats = {}
+        self.stage_random = random.Random(0)
 
     def record_epoch_losses(self, train_loss, val_loss, epoch):
         """
@@ -40,9 +51,82 @@ class Logger():
         self.logs['batch_loss'].append(loss)
         self.logs['batch_nr'].append(batch_num)
 
+    def record_validation_subset_loss(self, loss, epoch):
+        self.logs['validation_subset_loss'].append(loss)
+        self.logs['validation_subset_epoch_nr'].append(epoch)
+
+    def record_stage_times(self, stage_times, epoch):
+        """
+        Adds the time spent in every stage of a training step to running aggregates of the epoch.
+        Only the summary of every epoch is kept in the logs
+        """
+        if epoch != self.stage_epoch:
+            self.stage_epoch = epoch
+            self.stage_stats = {}
+        for stage, value in stage_times.items():
+            stats = self.stage_stats.setdefault(stage, {'count': 0, 'total': 0.0, 'reservoir': []})
+            stats['count'] += 1
+            stats['total'] += value
+            # Reservoir sampling keeps a uniform sample of the step times for the percentiles
+            if len(stats['reservoir']) < STAGE_RESERVOIR_SIZE:
+                stats['reservoir'].append(value)
+            else:
+                index = self.stage_random.randrange(stats['count'])
+                if index < STAGE_RESERVOIR_SIZE:
+                    stats['reservoir'][index] = value
+
+    def get_stage_breakdown(self, epoch):
+        """
+        Percentiles of the time spent in every training step stage during an epoch.
+        The breakdown of the running epoch is stored in the logs, replacing the previous one
+        """
+        if epoch != self.stage_epoch:
+            summaries = [summary['stages'] for summary in self.logs['stage_times'] if summary['epoch'] == epoch and 'stages' in summary]
+            return summaries[-1] if len(summaries) > 0 else {}
+        breakdown = {}
+        for stage, stats in self.stage_stats.items():
+            values = np.array(stats['reservoir'])
+            breakdown[stage] = {'total': stats['total'],
+                                'mean': stats['total'] / stats['count'],
+                                'p50': float(np.percentile(values, 50)),
+                                'p90': float(np.percentile(values, 90)),
+                                'p99': float(np.percentile(values, 99))}
+        total_time = sum(values['total'] for values in breakdown.values())
+        for values in breakdown.values():
+            values['fraction'] = values['total'] / total_time if total_time > 0 else 0.0
+        self.logs['stage_times'] = [summary for summary in self.logs['stage_times'] if summary['epoch'] != epoch]
+        self.logs['stage_times'].append({'epoch': epoch, 'stages': breakdown})
+        return breakdown
+
+    def record_memory(self, memory, phase, epoch):
+        """
+        Keeps the peak process RSS and tensor allocator memory (MB) of a phase of an epoch
+        """
+        self.logs['memory'].append({'epoch': epoch, 'phase': phase, 'rss': memory['rss'], 'allocated': memory['allocated']})
+
+    def get_memory_summary(self):
+        summary = {}
+        for record in self.logs['memory']:
+            phase = summary.setdefault(record['phase'], {'peak_rss': 0.0, 'peak_allocated': None})
+            phase['peak_rss'] = max(phase['peak_rss'], record['rss'])
+            if record['allocated'] is not None:
+                phase['peak_allocated'] = max(phase['peak_allocated'] or 0.0, record['allocated'])
+            phase['last_epoch_rss'] = record['rss']
+            phase['last_epoch_allocated'] = record['allocated']
+        return summary
+
     def get_best_val_loss(self):
-        if len(self.logs['validation_loss']) > 0:
-            best = min(self.logs['validation_loss'])
+        # Epochs without a full validation pass are recorded as NaN
+        validation_loss = np.array(self.logs['validation_loss'], dtype=float)
+        if np.any(~np.isnan(validation_loss)):
+            best = np.nanmin(validation_loss)
+        else:
+            best = np.Inf
+        return best
+
+    def get_best_val_subset_loss(self):
+        if len(self.logs['validation_subset_loss']) > 0:
+            best = min(self.logs['validation_subset_loss'])
         else:
             best = np.Inf
         return best
@@ -51,7 +135,15 @@ class Logger():
         return self.logs['%s_loss' % type][-1]
 
     def get_best_epoch(self):
-        return np.argmin(self.logs['validation_loss'])
+        return np.nanargmin(np.array(self.logs['validation_loss'], dtype=float))
+
+    def get_best_epoch_nr(self):
+        return self.logs['epoch_nr'][self.get_best_epoch()]
+
+    def get_epochs_since_best(self):
+        if np.isinf(self.get_best_val_loss()):
+            return 0
+        return self.get_last_epoch() - self.get_best_epoch_nr()
 
     def get_last_epoch(self):
         return self.logs['epoch_nr'][-1]
@@ -105,14 +197,23 @@ class Logger():
     def save_training_progress(self, file):
         progress = {'latest_epoch': self.get_last_epoch(),
                     'best_val_loss': self.get_best_val_loss(),
-                    'best_epoch': self.get_best_epoch(),
+                    'best_epoch': self.get_best_epoch() if not np.isinf(self.get_best_val_loss()) else None,
                     'total_time': time.time() - self.start_time,
                     'epoch_time': (time.time() - self.start_time) / (self.get_last_epoch() + 1)
                     }
+        if len(self.stage_stats) > 0 or len(self.logs['stage_times']) > 0:
+            progress['stage_breakdown'] = self.get_stage_breakdown(self.get_last_epoch())
+        if len(self.logs['memory']) > 0:
+            progress['memory'] = self.get_memory_summary()
         save_json(progress, file)
 
     def load_from_json(self, filename):
         self.logs = load_json(filename)
+        self.logs.setdefault('validation_subset_loss', [])
+        self.logs.setdefault('validation_subset_epoch_nr', [])
+        # Older logs kept the stage times of every batch
+        self.logs['stage_times'] = [summary for summary in self.logs.get('stage_times', []) if 'stages' in summary]
+        self.logs.setdefault('memory', [])
 
     def save_to_json(self, filename):
         save_json(self.logs, filename)
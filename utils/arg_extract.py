@@ -41,6 +41,7 @@ def get_args():
     parser.add_argument('--experiment_name', type=str, default="dummy", help='Experiment name - to be used for building the experiment folder')
     parser.add_argument('--normalizer_type', type=str, default='normal', help='how to normalize the images [normal, m1to1, none]')
     parser.add_argument('--num_workers', type=int, default=8, help='how many workers for the dataloader')
+    parser.add_argument('--resource_plan', type=str, default='none', help='How to split the cores between torch threads and dataloader workers [none, auto, measure]')
     parser.add_argument('--seed', type=int, default=12345, help='Seed to use for random number generator for experiment')
     parser.add_argument('--seed_everything', type=str2bool, default=True)
     parser.add_argument('--debug', type=str2bool, default=False)
@@ -50,11 +51,40 @@ def get_args():
     parser.add_argument('--scheduler_factor', type=float, default=0.1, help='Factor to reduce learning_rate')
     parser.add_argument('--continue_experiment', type=str2bool, default=False, help='Whether the experiment should continue from the last epoch')
     parser.add_argument('--back_and_forth', type=bool, default=False, help='If training will be with predicting both future and past')
+    parser.add_argument('--checkpoint_frequency', type=int, default=100, help='Save the full training state every that many batches (0: only at the end of each epoch)')
+    parser.add_argument('--validation_frequency', type=int, default=1, help='Run validation every that many epochs')
+    parser.add_argument('--validation_subset', type=float, default=1.0, help='Fraction of the validation sequences to validate on every epoch. A full pass runs only when the subset loss improves')
+    parser.add_argument('--early_stopping_patience', type=int, default=0, help='Stop training after that many epochs without a better validation loss (0: disabled)')
+    parser.add_argument('--profile_stages', type=str2bool, default=False, help='Time every stage of the training step and report the breakdown per epoch')
+    parser.add_argument('--profile_steps', type=str, default=None, help='Capture a torch profiler trace for the training steps a:b')
+    parser.add_argument('--memory_budget', type=float, default=0, help='Memory budget in MB. Warns when the configuration is likely to exceed it (0: disabled)')
+    parser.add_argument('--tbptt_steps', type=int, default=0, help='RNNs: backpropagate through chunks of that many output frames only (0: full rollout)')
+    parser.add_argument('--activation_checkpointing', type=int, default=0, help='ConvLSTM/PredRNN: recompute the activations during backward, keeping the state every that many time steps (0: disabled)')
+    parser.add_argument('--compile', type=str2bool, default=False, help='Compile the model (torch.compile, TorchScript on older torch) for training and evaluation')
+    parser.add_argument('--find_batch_size', type=str2bool, default=False, help='Find the largest batch size that fits the memory budget and suggest the most efficient one, then exit')
+    parser.add_argument('--image_size', type=int, default=None, help='Resolution the frames are resized and cropped to (default: 128 for training, the training resolution for testing)')
+    parser.add_argument('--patch_size', type=int, default=0, help='UNet/ResNet: train on random patches of that size, a multiple of 8 for UNet (0: full frames)')
+    parser.add_argument('--hard_window_sampling', type=str2bool, default=False, help='Sample the training windows of every sequence in proportion to their running loss, with importance weights')
+    parser.add_argument('--hard_window_uniform_mix', type=float, default=0.5, help='Fraction of the window sampling probability that is spread uniformly')
+    parser.add_argument('--teacher_experiment', type=str, default=None, help='Distill from the best model of that experiment')
+    parser.add_argument('--distillation_alpha', type=float, default=0.5, help='Weight of the teacher predictions against the ground truth in the distillation loss')
+    parser.add_argument('--teacher_cache_size', type=int, default=2000, help='How many teacher rollouts to cache, at about 0.6MB each for 20 output frames (0: no cache)')
     parser.add_argument('--reinsert_frequency', type=int, default=10, help='LSTM: how often to use the reinsert mechanism')
+    # PRUNING
+    parser.add_argument('--prune_amount', type=float, default=0.5, help='Fraction of the internal channels of every block to remove')
+    parser.add_argument('--prune_method', type=str, default='l1', help='How to rank the channels [l1, bn]')
+    parser.add_argument('--prune_finetune_epochs', type=int, default=2, help='Epochs to fine-tune the pruned model')
+    # QUANTIZATION
+    parser.add_argument('--calibration_batches', type=int, default=8, help='Validation batches to calibrate the int8 activation ranges on')
     # TESTING
     parser.add_argument('--test_starting_point', type=int, default=15, help='which frame to start the test')
     parser.add_argument('--num_total_output_frames', type=int, default=80, help='how many frames to predict to the future during evaluation')
     parser.add_argument('--get_sample_predictions', type=str2bool, default=True, help='Print sample predictions figures or not')
+    parser.add_argument('--tile_size', type=int, default=0, help='UNet/ResNet: predict frames larger than that in overlapping tiles of that size (0: disabled)')
+    parser.add_argument('--tile_overlap', type=int, default=32, help='Overlap in pixels between neighbouring tiles')
+    parser.add_argument('--ensemble_size', type=int, default=0, help='Models with dropout (AR_LSTM): predict the mean of that many Monte Carlo dropout samples, run as one batch, and report their spread against the error (0: deterministic)')
+    parser.add_argument('--optimize_inference', type=str2bool, default=True, help='Fold batch norms into the convolutions, remove dropout and use channels-last inputs for evaluation')
+    parser.add_argument('--benchmark_inference', type=str2bool, default=False, help='Check that optimize_inference does not change the predictions and time the speedup')
     parser.add_argument('--num_output_keep_frames', type=int, default=20, help='ConvLSTM: How many frames to keep from one pass to continue autoregression for longer outputs')
     parser.add_argument('--refeed', type=str2bool, default=False, help='Whether to use the refeed mechanism in RNNs')
 
@@ -74,6 +104,12 @@ def get_args():
             args.normalizer_type = 'normal'
         args.num_total_output_frames = 40
 
+    if args.model_type in ['unet', 'unet_small']:
+        # The three poolings of UNet need sizes that halve evenly, its skip connections fail otherwise
+        for name in ['patch_size', 'tile_size']:
+            if getattr(args, name) > 0 and getattr(args, name) % 8 != 0:
+                raise Warning('%s must be a multiple of 8 for UNet, got %d' % (name, getattr(args, name)))
+
     if args.seed_everything:
         seed_everything(args.seed)
 
@@ -0,0 +1,125 @@
+import logging
+import torch
+from utils.benchmark import time_training_step
+from utils.experiment import get_training_image_size
+from utils.memory import measure_training_step_memory, get_budgeted_memory, get_total_memory, get_current_rss
+
+
+# Sizes predicted to use more than this fraction of the budget are not run, the growth is not exactly linear
+PREDICTION_MARGIN = 0.9
+
+
+def _is_out_of_memory(error):
+    return 'out of memory' in str(error)
+
+
+class BatchSizeFinder():
+    """
+    Finds the largest batch size whose training step fits the memory budget and the batch size with the highest
+    throughput below it. The model is created from the experiment arguments, so memory is measured at the configured
+    number of input and output frames. On the CPU a step that exceeds the memory gets the process killed instead of
+    raising an error, so sizes are only run when the growth measured at smaller sizes predicts that they fit.
+    """
+    def __init__(self, experiment, memory_budget=0, max_batch_size=1024):
+        self.exp = experiment
+        self.args = experiment.args
+        self.memory_budget = memory_budget if memory_budget > 0 else get_total_memory()
+        if self.memory_budget is None:
+            raise Warning('Cannot determine the memory of this machine, set --memory_budget')
+        # The process RSS before any step, on the CPU only the memory a step adds is compared with the budget
+        self.baseline_rss = get_current_rss() or 0.0
+        self.max_batch_size = max_batch_size
+        self.image_size = self.args.patch_size if self.args.patch_size > 0 else get_training_image_size(self.args)
+        self.memory = {}
+
+    def _create_model(self):
+        return self.exp._create_model(self.args.model_type).to(self.exp.device)
+
+    def predict_memory(self, batch_size):
+        """
+        Linear extrapolation from the two largest batch sizes measured so far. None if there are too few measurements
+        """
+        sizes = sorted(b for b, memory in self.memory.items() if memory != float('inf') and b < batch_size)
+        if len(sizes) < 2:
+            return None
+        low, high = sizes[-2], sizes[-1]
+        growth = max(self.memory[high] - self.memory[low], 0.0) / (high - low)
+        return self.memory[high] + growth * (batch_size - high)
+
+    def fits(self, batch_size):
+        predicted = self.predict_memory(batch_size)
+        if predicted is not None and predicted > PREDICTION_MARGIN * self.memory_budget:
+            logging.info('Batch size %d: predicted %.0fMB of %.0fMB, not run' % (batch_size, predicted, self.memory_budget))
+            return False
+        model = self._create_model()
+        try:
+            memory = measure_training_step_memory(model, batch_size, self.args.num_input_frames, self.args.num_output_frames,
+                                                  self.exp.device, self.image_size, self.args.tbptt_steps)
+            if memory['allocated'] is None:
+                memory['rss'] -= self.baseline_rss
+            memory = get_budgeted_memory(memory)
+        except RuntimeError as e:
+            if not _is_out_of_memory(e):
+                raise
+            memory = float('inf')
+        del model
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+        self.memory[batch_size] = memory
+        logging.info('Batch size %d: %.0fMB of %.0fMB' % (batch_size, memory, self.memory_budget))
+        return memory <= self.memory_budget
+
+    def find_max_batch_size(self):
+        """
+        Doubles the batch size until it no longer fits, then binary searches between the last two sizes
+        """
+        if not self.fits(1):
+            return 0
+        low, high = 1, None
+        while high is None:
+            batch_size = low * 2
+            if batch_size > self.max_batch_size:
+                return low
+            if self.fits(batch_size):
+                low = batch_size
+            else:
+                high = batch_size
+        while high - low > 1:
+            batch_size = (low + high) // 2
+            if self.fits(batch_size):
+                low = batch_size
+            else:
+                high = batch_size
+        return low
+
+    def measure_throughput(self, batch_size, repeats=3):
+        model = self._create_model()
+        input_frames = torch.randn(batch_size, self.args.num_input_frames, self.image_size, self.image_size, device=self.exp.device)
+        step_time = time_training_step(model, input_frames, self.args.num_output_frames, repeats)
+        del model
+        return batch_size / step_time
+
+    def run(self):
+        max_batch_size = self.find_max_batch_size()
+        if max_batch_size == 0:
+            logging.warning('Model %s does not fit the memory budget of %.0fMB even with batch size 1' % (self.args.model_type, self.memory_budget))
+            return {'max_batch_size': 0, 'suggested_batch_size': None, 'memory': self.memory, 'throughput': {}}
+        candidates = sorted(set(max(1, max_batch_size // d) for d in [8, 4, 2, 1]))
+        throughput = {}
+        for batch_size in candidates:
+            throughput[batch_size] = self.measure_throughput(batch_size)
+            logging.info('Batch size %d: %.1f samples/s' % (batch_size, throughput[batch_size]))
+        # Prefer the smallest batch size within 5% of the best throughput, larger batches rarely pay off in convergence
+        best_throughput = max(throughput.values())
+        suggested_batch_size = min(b for b in candidates if throughput[b] >= 0.95 * best_throughput)
+        logging.info('Largest batch size that fits %.0fMB: %d. Suggested batch size: %d (%.1f samples/s)' %
+                     (self.memory_budget, max_batch_size, suggested_batch_size, throughput[suggested_batch_size]))
+        return {'model_type': self.args.model_type,
+                'num_input_frames': self.args.num_input_frames,
+                'num_output_frames': self.args.num_output_frames,
+                'image_size': self.image_size,
+                'memory_budget': self.memory_budget,
+                'max_batch_size': max_batch_size,
+                'suggested_batch_size': suggested_batch_size,
+                'memory': self.memory,
+                'throughput': throughput}
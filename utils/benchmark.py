@@ -0,0 +1,88 @@
+import copy
+import time
+import numpy as np
+import torch
+import torch.nn as nn
+from models.CausalLSTM import CausalLSTMCell
+
+
+def synchronize():
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+
+
+def time_rollout(model, input_frames, num_total_output_frames, refeed=False, repeats=5):
+    """
+    Median wall time in seconds of an inference rollout
+    """
+    model.eval()
+    times = []
+    with torch.no_grad():
+        for _ in range(repeats):
+            synchronize()
+            start_time = time.time()
+            model.get_future_frames(input_frames, num_total_output_frames, refeed)
+            synchronize()
+            times.append(time.time() - start_time)
+    return float(np.median(times))
+
+
+def time_training_step(model, input_frames, num_output_frames, repeats=5):
+    """
+    Median wall time in seconds of a forward and backward pass. The parameters and buffers are left untouched
+    """
+    state = copy.deepcopy(model.state_dict())
+    model.train()
+    times = []
+    for _ in range(repeats):
+        synchronize()
+        start_time = time.time()
+        output_frames = model.get_future_frames(input_frames, num_output_frames, False)
+        output_frames.mean().backward()
+        synchronize()
+        times.append(time.time() - start_time)
+    for param in model.parameters():
+        param.grad = None
+    model.load_state_dict(state)
+    return float(np.median(times))
+
+
+def count_flops(model, input_frames):
+    """
+    Floating point operations of the convolutions and linear layers in one forward pass
+    """
+    flops = []
+
+    def hook(module, inputs, output):
+        if isinstance(module, nn.ConvTranspose2d):
+            # Every input element is scattered to out_channels x kernel size outputs
+            flops.append(2 * inputs[0].numel() * module.weight[0].numel())
+        else:
+            flops.append(2 * output.numel() * module.weight[0].numel())
+
+    handles = [m.register_forward_hook(hook) for m in model.modules() if isinstance(m, (nn.Conv2d, nn.ConvTranspose2d, nn.Linear))]
+    model.eval()
+    with torch.no_grad():
+        model(input_frames)
+    for handle in handles:
+        handle.remove()
+    return int(sum(flops))
+
+
+def compare_fused_gates(model, input_frames, num_total_output_frames, repeats=5):
+    """
+    Rollout time of a PredRNN++ model with the fused and with the separate state convolutions of its cells,
+    and the largest absolute difference of their predictions
+    """
+    cells = [m for m in model.modules() if isinstance(m, CausalLSTMCell)]
+    report = {}
+    outputs = {}
+    for fused in [False, True]:
+        for cell in cells:
+            cell.fuse_gates = fused
+        name = 'fused' if fused else 'unfused'
+        report['%s_time' % name] = time_rollout(model, input_frames, num_total_output_frames, repeats=repeats)
+        with torch.no_grad():
+            outputs[name] = model.get_future_frames(input_frames, num_total_output_frames, False)
+    report['max_error'] = float((outputs['fused'] - outputs['unfused']).abs().max())
+    return report
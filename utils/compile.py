@@ -0,0 +1,28 @@
+import logging
+import os
+import torch
+
+# Models whose forward is a plain tensor graph, these can be traced by TorchScript
+TRACEABLE_MODELS = ['resnet', 'resnet_dilated', 'unet', 'unet_small']
+
+
+def compile_model(model, model_type, cache_dir, example_input, train):
+    """
+    Compiles the forward of the model in place and returns the backend used.
+    torch.compile is used when available. Older versions of torch fall back to TorchScript tracing,
+    which freezes the train/eval mode, so it is only used for inference of the convolutional models.
+    """
+    if hasattr(torch, 'compile'):
+        # Compiled kernels are cached on disk and reused by later runs
+        os.environ.setdefault('TORCHINDUCTOR_CACHE_DIR', cache_dir)
+        os.environ.setdefault('TORCHINDUCTOR_FX_GRAPH_CACHE', '1')
+        model.forward = torch.compile(model.forward)
+        return 'torch.compile'
+    if model_type in TRACEABLE_MODELS and not train:
+        model.eval()
+        with torch.no_grad():
+            traced = torch.jit.trace(model, example_input)
+        model.forward = traced.forward
+        return 'torchscript'
+    logging.warning('Model %s cannot be compiled with this version of torch, running eagerly' % model_type)
+    return 'eager'
@@ -0,0 +1,54 @@
+import hashlib
+import logging
+import torch
+from collections import OrderedDict
+
+
+class TeacherCache():
+    """
+    Least recently used cache of the teacher rollouts, keyed by the hash of the input window of every sequence,
+    so that windows that come up again in later epochs do not need another teacher forward.
+    Outputs are stored on the CPU in half precision.
+    """
+    def __init__(self, teacher, max_size=2000):
+        self.teacher = teacher
+        self.teacher.eval()
+        self.max_size = max_size
+        self.cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def _key(self, input_frames, num_output_frames):
+        return hashlib.sha1(input_frames.cpu().numpy().tobytes()).hexdigest() + '_%d' % num_output_frames
+
+    def get_future_frames(self, input_frames, num_output_frames):
+        if self.max_size <= 0:
+            with torch.no_grad():
+                return self.teacher.get_future_frames(input_frames, num_output_frames, False)
+        keys = [self._key(frames, num_output_frames) for frames in input_frames]
+        missing = [i for i, key in enumerate(keys) if key not in self.cache]
+        self.hits += len(keys) - len(missing)
+        self.misses += len(missing)
+        outputs = {}
+        if len(missing) > 0:
+            with torch.no_grad():
+                teacher_frames = self.teacher.get_future_frames(input_frames[missing], num_output_frames, False)
+            for i, frames in zip(missing, teacher_frames):
+                outputs[keys[i]] = frames
+                self.cache[keys[i]] = frames.to('cpu', torch.half)
+        for key in keys:
+            if key not in outputs:
+                self.cache.move_to_end(key)
+                outputs[key] = self.cache[key].to(input_frames.device, input_frames.dtype)
+        while len(self.cache) > self.max_size:
+            self.cache.popitem(last=False)
+        return torch.stack([outputs[key] for key in keys])
+
+    def get_hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total > 0 else 0.0
+
+    def log_stats(self):
+        logging.info('Teacher cache: %d windows, %.0f%% hits' % (len(self.cache), 100 * self.get_hit_rate()))
+        self.hits = 0
+        self.misses = 0
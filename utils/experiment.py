@@ -2,19 +2,33 @@ import logging
 import torch
 import os
 import random
+import inspect
+import zipfile
+import numpy as np
 from argparse import Namespace
+from functools import partial
 from utils.WaveDataset import WaveDataset
+from utils.samplers import ResumableRandomSampler, HardWindowSampler
 from torchvision import transforms
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, Subset
 from utils.io import save, load, save_json, load_json
 from utils.Logger import Logger
+from utils.compile import compile_model
+from utils.inference import optimize_for_inference, CHANNELS_LAST_MODELS, INFERENCE_TOLERANCE
+from utils.pruning import apply_pruning_spec
+from utils.benchmark import time_rollout, time_training_step
+from utils.resources import get_available_cores, plan_resources, apply_resource_plan, PinnedWorkerInit, measure_plan_step_time
 from models.AR_LSTM import AR_LSTM
 from models.ConvLSTM import get_convlstm_model
 from models.ResNet import resnet12
 from models.PredRNNPP import PredRNNPP
 from models.UNet import UNet
+from models.FNO import FNO
 import configparser
 
+LAZY_LOADING = 'mmap' in inspect.signature(torch.load).parameters and 'assign' in inspect.signature(torch.nn.Module.load_state_dict).parameters
+
+
 def get_normalizer(normalizer):
     normalizers = {'none': {'mean': 0.0, 'std': 1.0},  # leave as is
                    'normal': {'mean': 0.5047, 'std': 0.1176},  # mean 0 std 1
@@ -23,15 +37,23 @@ def get_normalizer(normalizer):
     return normalizers[normalizer]
 
 
-def get_transforms(normalizer):
+# Resolution frames are trained at when --image_size is not given, the simulated frames are 184 x 184
+DEFAULT_IMAGE_SIZE = 128
+
+
+def get_training_image_size(args):
+    return args.image_size if args.image_size is not None else DEFAULT_IMAGE_SIZE
+
+
+def get_transforms(normalizer, image_size=DEFAULT_IMAGE_SIZE):
     trans = {"Test": transforms.Compose([
-        transforms.Resize(128),  # Already 184 x 184
-        transforms.CenterCrop(128),
+        transforms.Resize(image_size),  # Already 184 x 184
+        transforms.CenterCrop(image_size),
         transforms.ToTensor(),
         transforms.Normalize(mean=[normalizer['mean']], std=[normalizer['std']])
     ]), "Train": transforms.Compose([
-        transforms.Resize(128),  # Already 184 x 184
-        transforms.CenterCrop(128),
+        transforms.Resize(image_size),  # Already 184 x 184
+        transforms.CenterCrop(image_size),
         transforms.RandomHorizontalFlip(),
         transforms.RandomVerticalFlip(),
         transforms.ToTensor(),
@@ -39,11 +61,11 @@ def get_transforms(normalizer):
     return trans
 
 
-def create_new_datasets(data_directory, normalizer, back_and_forth=False):
+def create_new_datasets(data_directory, normalizer, back_and_forth=False, image_size=DEFAULT_IMAGE_SIZE):
     logging.info('Creating new datasets')
     test_fraction = 0.15
     validation_fraction = 0.15
-    transform = get_transforms(normalizer)
+    transform = get_transforms(normalizer, image_size)
 
     # classes = os.listdir(data_directory)
     classes = [dI for dI in os.listdir(data_directory) if os.path.isdir(os.path.join(data_directory, dI))]
@@ -86,17 +108,27 @@ def load_datasets(filename_data):
     return datasets
 
 
-def create_dataloaders(datasets, batch_size, num_workers):
+def create_dataloaders(datasets, batch_size, num_workers, worker_init_fn=None):
     train_dataset = datasets["Training data"]
     val_dataset = datasets["Validation data"]
     test_dataset = datasets["Testing data"]
     dataloaders = {}
-    dataloaders['train'] = DataLoader(train_dataset, batch_size=batch_size, shuffle=True, num_workers=num_workers)
-    dataloaders['val'] = DataLoader(val_dataset, batch_size=batch_size, shuffle=True, num_workers=num_workers)
-    dataloaders['test'] = DataLoader(test_dataset, batch_size=batch_size, shuffle=True, num_workers=num_workers)
+    dataloaders['train'] = DataLoader(train_dataset, batch_size=batch_size, sampler=ResumableRandomSampler(train_dataset), num_workers=num_workers, worker_init_fn=worker_init_fn)
+    dataloaders['val'] = DataLoader(val_dataset, batch_size=batch_size, shuffle=True, num_workers=num_workers, worker_init_fn=worker_init_fn)
+    dataloaders['test'] = DataLoader(test_dataset, batch_size=batch_size, shuffle=True, num_workers=num_workers, worker_init_fn=worker_init_fn)
     return dataloaders
 
 
+def create_subset_dataloader(dataloader, fraction, seed):
+    """
+    Returns a dataloader over a fixed random subset of the dataloader's sequences
+    """
+    dataset = dataloader.dataset
+    num_sequences = max(1, int(len(dataset) * fraction))
+    indices = sorted(random.Random(seed).sample(range(len(dataset)), num_sequences))
+    return DataLoader(Subset(dataset, indices), batch_size=dataloader.batch_size, shuffle=False, num_workers=dataloader.num_workers, worker_init_fn=dataloader.worker_init_fn)
+
+
 def get_device():
     if torch.cuda.is_available():
         device = torch.cuda.current_device()
@@ -115,16 +147,70 @@ def save_network(model, filename):
     torch.save(network_dict, filename)
 
 
-def load_network(model, filename):
+def load_network(model, filename, assign=False):
     logging.info('Loading model %s' % filename)
-    dct = torch.load(filename, map_location='cpu')
+    if assign and zipfile.is_zipfile(filename):
+        # The tensors are mapped from the file and only read from disk when they are used
+        dct = torch.load(filename, map_location='cpu', mmap=True, weights_only=True)
+    else:
+        if assign:
+            logging.warning('%s is in the legacy format and cannot be memory-mapped, convert it with scripts/convert_checkpoints.py' % filename)
+        dct = torch.load(filename, map_location='cpu')
     try:
-        model.load_state_dict(dct)
+        if assign:
+            model.load_state_dict(dct, assign=True)
+        else:
+            model.load_state_dict(dct)
     except Exception:
         raise Warning('model and dictionary mismatch')
     return model
 
 
+def create_and_load_network(create_model, filename):
+    """
+    Builds the model on the meta device, so that no weights are allocated or initialized, and assigns the tensors of
+    filename to it. Needs torch >= 2.1, older versions create the model and copy the weights. The file must not be
+    overwritten while the model is in use
+    """
+    if not LAZY_LOADING:
+        return load_network(create_model(), filename)
+    with torch.device('meta'):
+        model = create_model()
+    return load_network(model, filename, assign=True)
+
+
+def get_rng_states():
+    states = {'python': random.getstate(),
+              'numpy': np.random.get_state(),
+              'torch': torch.get_rng_state()}
+    if torch.cuda.is_available():
+        states['cuda'] = torch.cuda.get_rng_state_all()
+    return states
+
+
+def set_rng_states(states):
+    random.setstate(states['python'])
+    np.random.set_state(states['numpy'])
+    torch.set_rng_state(states['torch'])
+    if 'cuda' in states and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(states['cuda'])
+
+
+def save_checkpoint(checkpoint, filename):
+    # Write to a temporary file first so a job killed mid-write never leaves a corrupt checkpoint
+    tmp_filename = filename + '.tmp'
+    torch.save(checkpoint, tmp_filename)
+    os.replace(tmp_filename, filename)
+
+
+def load_checkpoint(filename):
+    logging.info('Loading checkpoint %s' % filename)
+    try:
+        return torch.load(filename, map_location='cpu', weights_only=False)
+    except TypeError:  # older torch versions have no weights_only argument
+        return torch.load(filename, map_location='cpu')
+
+
 class Experiment():
     def __init__(self, args):
         logging.info('Experiment %s' % args.experiment_name)
@@ -138,9 +224,9 @@ class Experiment():
         if model_type == 'ar_lstm':
             model = AR_LSTM(self.args.num_input_frames, self.args.num_output_frames, self.args.reinsert_frequency, self.device)
         elif model_type == 'convlstm':
-            model = get_convlstm_model(self.args.num_input_frames, self.args.num_output_frames, self.args.batch_size, self.device, dilation=1, padding=1)
+            model = get_convlstm_model(self.args.num_input_frames, self.args.num_output_frames, self.device, dilation=1, padding=1)
         elif model_type =='dilated_convlstm':
-            model =  get_convlstm_model(self.args.num_input_frames, self.args.num_output_frames, self.args.batch_size, self.device, dilation=2, padding=2)
+            model =  get_convlstm_model(self.args.num_input_frames, self.args.num_output_frames, self.device, dilation=2, padding=2)
         elif model_type == 'predrnn':
             model = PredRNNPP(self.args.num_input_frames, self.args.num_output_frames, self.device, use_GHU=False)
         elif model_type == 'predrnn_ghu':
@@ -153,8 +239,17 @@ class Experiment():
             model = UNet(self.args.num_input_frames, self.args.num_output_frames, isize=64)
         elif model_type == 'unet_small':
             model = UNet(self.args.num_input_frames, self.args.num_output_frames, isize=16)
+        elif model_type == 'fno':
+            model = FNO(self.args.num_input_frames, self.args.num_output_frames, modes=12, width=32)
         else:
             raise Warning('Not supported model')
+        if os.path.isfile(self.files['pruning']):
+            apply_pruning_spec(model, load_json(self.files['pruning']))
+        if getattr(self.args, 'activation_checkpointing', 0) > 0:
+            if hasattr(model, 'set_activation_checkpointing'):
+                model.set_activation_checkpointing(self.args.activation_checkpointing)
+            else:
+                logging.warning('Model %s does not support activation checkpointing' % model_type)
         return model
 
     def _create_scheduler(self):
@@ -165,59 +260,285 @@ class Experiment():
                                                           factor=self.args.scheduler_factor,
                                                           patience=self.args.scheduler_patience)
 
+    def load_teacher(self):
+        """
+        Loads the best model of the teacher experiment for distillation
+        """
+        teacher_args = Namespace(**vars(self.args))
+        teacher_args.experiment_name = self.args.teacher_experiment
+        teacher = Experiment(teacher_args)
+        teacher.args = Namespace(**teacher._load_metadata()['args'])
+        if teacher.args.num_input_frames != self.args.num_input_frames:
+            raise Warning('Teacher %s takes %d input frames, the student %d' % (self.args.teacher_experiment, teacher.args.num_input_frames, self.args.num_input_frames))
+        model = create_and_load_network(partial(teacher._create_model, teacher.args.model_type), teacher.files['model_best'])
+        for param in model.parameters():
+            param.requires_grad = False
+        return model.to(self.device)
+
+    def _create_window_sampler(self):
+        if not self.args.hard_window_sampling:
+            return None
+        return HardWindowSampler(len(self.datasets['Training data']), uniform_mix=self.args.hard_window_uniform_mix)
+
     def create_new(self):
         assert self.args.model_type is not None, "Please specify model type when starting new experiment"
 
+        self.args.image_size = get_training_image_size(self.args)
         self.normalizer = get_normalizer(self.args.normalizer_type)
-        self.datasets = create_new_datasets(self.get_train_data_dir(), self.normalizer, self.args.back_and_forth)
+        self.datasets = create_new_datasets(self.get_train_data_dir(), self.normalizer, self.args.back_and_forth, self.args.image_size)
         save(self.datasets, self.files['datasets'])
-        self.dataloaders = create_dataloaders(self.datasets, self.args.batch_size, self.args.num_workers)
         self.model = self._create_model(self.args.model_type)
+        self.model.to(self.device)
+        self._plan_resources(self.args.resource_plan, self.args.num_workers)
+        self.dataloaders = create_dataloaders(self.datasets, self.args.batch_size, self.resources['num_workers'], self.worker_init_fn)
         self.lr_scheduler = self._create_scheduler()
+        self.window_sampler = self._create_window_sampler()
         self._save_metadata()
         self.logger = Logger()
-        self.model.to(self.device)
         self.starting_epoch = 0
+        self.starting_batch = 0
+        self.resumed_epoch_losses = None
+        if self.args.compile:
+            self.compile(train=True)
 
     def load_from_disk(self, test=True):
         self.args_new = self.args
         self.metadata = self._load_metadata()
         self.args = Namespace(**self.metadata['args'])
         self.args.num_epochs = self.args_new.num_epochs  # we are going to be using the new epochs
+        self.args.checkpoint_frequency = self.args_new.checkpoint_frequency
+        self.args.validation_frequency = self.args_new.validation_frequency
+        self.args.validation_subset = self.args_new.validation_subset
+        self.args.early_stopping_patience = self.args_new.early_stopping_patience
+        self.args.profile_stages = self.args_new.profile_stages
+        self.args.profile_steps = self.args_new.profile_steps
+        self.args.memory_budget = self.args_new.memory_budget
+        self.args.tbptt_steps = self.args_new.tbptt_steps
+        self.args.activation_checkpointing = self.args_new.activation_checkpointing
+        self.args.hard_window_sampling = self.args_new.hard_window_sampling
+        self.args.hard_window_uniform_mix = self.args_new.hard_window_uniform_mix
+        self.args.teacher_cache_size = self.args_new.teacher_cache_size
+        if not hasattr(self.args, 'teacher_experiment'):
+            self.args.teacher_experiment = None
+            self.args.distillation_alpha = 0.5
         if not hasattr(self.args, 'dataset'):
             self.args.dataset = 'original'
+        if not hasattr(self.args, 'image_size'):
+            self.args.image_size = DEFAULT_IMAGE_SIZE
+        self.args.patch_size = self.args_new.patch_size
         self.normalizer = get_normalizer(self.args.normalizer_type)
         self.datasets = load_datasets(self.files['datasets'])
         self.datasets['Training data'].root_dir = self.get_train_data_dir()
-        self.datasets['Training data'].transform = get_transforms(self.normalizer)['Train']
+        self.datasets['Training data'].transform = get_transforms(self.normalizer, self.args.image_size)['Train']
+        # Testing can evaluate at another resolution than the model was trained at
+        if not test or self.args_new.image_size is None:
+            self.args_new.image_size = self.args.image_size
         self.datasets['Validation data'].root_dir = self.get_train_data_dir()
-        self.datasets['Validation data'].transform = get_transforms(self.normalizer)['Test']
+        self.datasets['Validation data'].transform = get_transforms(self.normalizer, self.args_new.image_size)['Test']
         self.datasets['Testing data'].root_dir = self.get_train_data_dir()
-        self.datasets['Testing data'].transform = get_transforms(self.normalizer)['Test']
+        self.datasets['Testing data'].transform = get_transforms(self.normalizer, self.args_new.image_size)['Test']
         if test:
             file = self.files['model_best']
-            self.dataloaders = create_dataloaders(self.datasets, self.args.batch_size, self.args_new.num_workers)
+            num_workers = self.args_new.num_workers
         else:
             logging.info('Loading latest model to continue with batch_size %s' % self.args.batch_size)
             file = self.files['model_latest']
-            self.dataloaders = create_dataloaders(self.datasets, self.args.batch_size, self.args.num_workers)
-        self.model = self._create_model(self.args.model_type)
-        self.model = load_network(self.model, file)
+            num_workers = self.args.num_workers
+        if test:
+            self.model = create_and_load_network(partial(self._create_model, self.args.model_type), file)
+        else:
+            # model_latest.pt is overwritten during training, so it is not memory-mapped
+            self.model = load_network(self._create_model(self.args.model_type), file)
         self.model.to(self.device)
-        # self.lr_scheduler = self._create_scheduler()
+        if test and self.args_new.tile_size > 0:
+            if hasattr(self.model, 'set_tiling'):
+                self.model.set_tiling(self.args_new.tile_size, self.args_new.tile_overlap)
+            else:
+                logging.warning('Model %s is not fully convolutional, tiled inference is ignored' % self.args.model_type)
+        if test and self.args_new.optimize_inference:
+            self.optimize_for_inference()
+        # Measuring only pays off for training, loading for testing and evaluation uses the one core per worker split
+        resource_plan = self.args_new.resource_plan
+        if test and resource_plan == 'measure':
+            resource_plan = 'auto'
+        self._plan_resources(resource_plan, num_workers)
+        if not test and 'num_cores' in self.resources:
+            self.metadata['resources'] = self.resources
+            save_json(self.metadata, self.files['metadata'] + '.json')
+        self.dataloaders = create_dataloaders(self.datasets, self.args.batch_size, self.resources['num_workers'], self.worker_init_fn)
         self.logger = Logger()
         self.logger.load_from_json(self.files['logger'])
         self.starting_epoch = self.logger.get_last_epoch() + 1
+        self.starting_batch = 0
+        self.resumed_epoch_losses = None
+        self.window_sampler = None
+        if not test:
+            self.lr_scheduler = self._create_scheduler()
+            self.window_sampler = self._create_window_sampler()
+            if os.path.isfile(self.files['checkpoint']):
+                self._resume_from_checkpoint()
+        if self.args_new.compile:
+            self.compile(train=not test)
         logging.info(self.args)
 
         # Plus more stuff to get the best val accuracy and the last epoch numbers
 
+    def _plan_resources(self, mode, num_workers):
+        """
+        Splits the cores between torch threads and DataLoader workers.
+        none: leave torch defaults, auto: one core per worker and the rest for the main process,
+        measure: time a few training steps for several splits and keep the fastest
+        """
+        self.worker_init_fn = None
+        if mode == 'none':
+            self.resources = {'num_workers': num_workers}
+            return
+        elif mode == 'auto':
+            plan = plan_resources(num_workers)
+        elif mode == 'measure':
+            plan = self._measure_resource_plans(num_workers)
+        else:
+            raise Warning('Not supported resource plan %s' % mode)
+        apply_resource_plan(plan)
+        self.resources = plan
+        self.worker_init_fn = PinnedWorkerInit(plan['worker_cores'])
+        logging.info('Resource plan: %d workers, %d intra-op threads, %d inter-op threads on %d cores' %
+                     (plan['num_workers'], plan['intra_op_threads'], plan['inter_op_threads'], plan['num_cores']))
+
+    def _measure_resource_plans(self, num_workers):
+        cores = get_available_cores()
+        candidates = sorted(set(min(w, len(cores) - 1) for w in [1, 2, 4, 8, 12, 16, num_workers]))
+        best_plan = None
+        for candidate in candidates:
+            for inter_op_threads in [1, 2, 4]:
+                plan = plan_resources(candidate, cores, inter_op_threads)
+                if plan['inter_op_threads'] != inter_op_threads:
+                    continue
+                plan['step_time'] = measure_plan_step_time(plan, self.model, self.datasets['Training data'], self.args.batch_size,
+                                                           self.args.num_input_frames, self.args.num_output_frames, self.device)
+                logging.info('%d workers, %d intra-op threads, %d inter-op threads: %.3fs per step' %
+                             (plan['num_workers'], plan['intra_op_threads'], plan['inter_op_threads'], plan['step_time']))
+                if best_plan is None or plan['step_time'] < best_plan['step_time']:
+                    best_plan = plan
+        return best_plan
+
+    def optimize_for_inference(self):
+        """
+        Optimizes the loaded model for evaluation. With benchmark_inference, also checks that its predictions
+        do not change and reports the speedup
+        """
+        benchmark = self.args_new.benchmark_inference
+        if benchmark:
+            image_size = self.args_new.image_size
+            input_frames = torch.rand(self.args.batch_size, self.args.num_input_frames, image_size, image_size, device=self.device)
+            num_output_frames = self.args_new.num_total_output_frames
+            time_model = lambda: time_rollout(self.model, input_frames, num_output_frames, self.args_new.refeed, repeats=3)
+            self.model.eval()
+            with torch.no_grad():
+                reference = self.model.get_future_frames(input_frames, num_output_frames, self.args_new.refeed)
+            eager_time = time_model()
+        # Monte Carlo ensembles sample from the dropout layers
+        changes = optimize_for_inference(self.model, channels_last=self.args.model_type in CHANNELS_LAST_MODELS,
+                                         freeze_dropout=self.args_new.ensemble_size <= 1)
+        logging.info('Optimized %s for inference (%d batch norms folded, %d dropouts removed, channels last: %s)' %
+                     (self.args.model_type, changes['folded_batch_norms'], changes['frozen_dropouts'], changes['channels_last']))
+        if not benchmark:
+            return
+        with torch.no_grad():
+            output = self.model.get_future_frames(input_frames, num_output_frames, self.args_new.refeed)
+        optimized_time = time_model()
+        report = dict(changes,
+                      model_type=self.args.model_type,
+                      batch_size=self.args.batch_size,
+                      image_size=image_size,
+                      num_output_frames=num_output_frames,
+                      max_error=(output - reference).abs().max().item(),
+                      eager_time=eager_time,
+                      optimized_time=optimized_time,
+                      speedup=eager_time / optimized_time)
+        logging.info('%.3fs -> %.3fs per rollout (%.2fx), max error %.2e' %
+                     (eager_time, optimized_time, report['speedup'], report['max_error']))
+        if report['max_error'] > INFERENCE_TOLERANCE:
+            logging.warning('The optimized model deviates by %.2e from the original one (tolerance %.0e)' % (report['max_error'], INFERENCE_TOLERANCE))
+        save_json(report, self.files['inference_report'])
+
+    def compile(self, train):
+        """
+        Compiles the model, warms it up on the shapes used for training or evaluation and reports the speedup
+        """
+        if train:
+            image_size = self.args.patch_size if self.args.patch_size > 0 else self.args.image_size
+        else:
+            image_size = self.args_new.image_size
+        input_frames = torch.zeros(self.args.batch_size, self.args.num_input_frames, image_size, image_size, device=self.device)
+        if train:
+            num_output_frames = self.args.num_output_frames
+            time_model = lambda repeats: time_training_step(self.model, input_frames, num_output_frames, repeats=repeats)
+        else:
+            num_output_frames = self.args_new.num_total_output_frames
+            time_model = lambda repeats: time_rollout(self.model, input_frames, num_output_frames, self.args_new.refeed, repeats=repeats)
+        eager_time = time_model(3)
+        backend = compile_model(self.model, self.args.model_type, self.dirs['compile_cache'], input_frames, train)
+        warm_up_time = time_model(1)
+        if train:
+            # Evaluation mode is compiled separately and runs on full frames, warm it up too
+            eval_frames = input_frames.new_zeros(1, self.args.num_input_frames, self.args.image_size, self.args.image_size)
+            time_rollout(self.model, eval_frames, self.args.num_total_output_frames, repeats=1)
+        compiled_time = time_model(3)
+        report = {'model_type': self.args.model_type,
+                  'backend': backend,
+                  'mode': 'train' if train else 'test',
+                  'batch_size': self.args.batch_size,
+                  'image_size': image_size,
+                  'num_output_frames': num_output_frames,
+                  'eager_time': eager_time,
+                  'warm_up_time': warm_up_time,
+                  'compiled_time': compiled_time,
+                  'speedup': eager_time / compiled_time}
+        logging.info('Compiled %s with %s in %.1fs: %.3fs -> %.3fs per %s (%.2fx)' %
+                     (self.args.model_type, backend, warm_up_time, eager_time, compiled_time, 'training step' if train else 'rollout', report['speedup']))
+        save_json(report, self.files['compile_report'] % report['mode'])
+
+    def save_checkpoint(self, epoch, batch_num, epoch_losses):
+        """
+        Saves the full training state. epoch and batch_num point to the next batch that should be run.
+        """
+        sampler = self.dataloaders['train'].sampler
+        checkpoint = {'epoch': epoch,
+                      'batch_num': batch_num,
+                      'model': self.model.module.state_dict() if hasattr(self.model, 'module') else self.model.state_dict(),
+                      'optimizer': self.lr_scheduler.optimizer.state_dict(),
+                      'scheduler': self.lr_scheduler.state_dict(),
+                      'rng': get_rng_states(),
+                      'sampler': sampler.state_dict(batch_num * self.args.batch_size) if batch_num > 0 else None,
+                      'window_sampler': self.window_sampler.state_dict() if self.window_sampler is not None else None,
+                      'logger': self.logger.logs,
+                      'epoch_losses': epoch_losses}
+        save_checkpoint(checkpoint, self.files['checkpoint'])
+
+    def _resume_from_checkpoint(self):
+        checkpoint = load_checkpoint(self.files['checkpoint'])
+        self.model.load_state_dict(checkpoint['model'])
+        self.lr_scheduler.optimizer.load_state_dict(checkpoint['optimizer'])
+        self.lr_scheduler.load_state_dict(checkpoint['scheduler'])
+        self.logger.logs = checkpoint['logger']
+        self.starting_epoch = checkpoint['epoch']
+        self.starting_batch = checkpoint['batch_num']
+        if checkpoint['sampler'] is not None:
+            self.dataloaders['train'].sampler.load_state_dict(checkpoint['sampler'])
+            self.resumed_epoch_losses = checkpoint['epoch_losses']
+        if self.window_sampler is not None and checkpoint.get('window_sampler') is not None:
+            self.window_sampler.load_state_dict(checkpoint['window_sampler'])
+        set_rng_states(checkpoint['rng'])
+        logging.info('Resuming from checkpoint at epoch %d batch %d' % (self.starting_epoch, self.starting_batch))
+
     def _save_metadata(self):
         logging.info(self.args)
         meta_data_dict = {"args": vars(self.args),
                           "optimizer": self.lr_scheduler.optimizer.state_dict(),
                           "scheduler": self.lr_scheduler.state_dict(),
-                          "model": "%s" % self.model
+                          "model": "%s" % self.model,
+                          "resources": self.resources
                           }
         save(meta_data_dict, self.files['metadata'])
         save_json(meta_data_dict, self.files['metadata'] + '.json')
@@ -255,6 +576,7 @@ class Experiment():
         self.dirs['experiments'] = config['paths']['experiments']
 
         self.dirs['results'] = os.path.join(self.dirs['experiments'], self.args.experiment_name)
+        self.dirs['compile_cache'] = os.path.join(self.dirs['experiments'], 'compile_cache')
         for d in self.sub_folders:
             self.dirs[d] = os.path.join(self.dirs['results'], '%s/' % d)
 
@@ -270,4 +592,13 @@ class Experiment():
             self.files['evaluator'] = os.path.join(self.dirs['pickles'], 'evaluator_%s_sp_%d.pickle')
         self.files['model_latest'] = os.path.join(self.dirs['models'], 'model_latest.pt')
         self.files['model_best'] = os.path.join(self.dirs['models'], 'model_best.pt')
+        self.files['checkpoint'] = os.path.join(self.dirs['models'], 'checkpoint.pt')
+        self.files['pruning'] = os.path.join(self.dirs['models'], 'pruning.json')
+        self.files['pruning_report'] = os.path.join(self.dirs['training'], 'pruning.json')
+        self.files['model_int8'] = os.path.join(self.dirs['models'], 'model_int8.pt')
+        self.files['quantization_report'] = os.path.join(self.dirs['training'], 'quantization.json')
         self.files['progress'] = os.path.join(self.dirs['training'], "progress.json")
+        self.files['trace'] = os.path.join(self.dirs['training'], "trace.json")
+        self.files['batch_size_report'] = os.path.join(self.dirs['training'], "batch_size.json")
+        self.files['compile_report'] = os.path.join(self.dirs['training'], "compile_%s.json")
+        self.files['inference_report'] = os.path.join(self.dirs['training'], "inference.json")
@@ -17,6 +17,7 @@ from utils.plotting import get_cutthrough_plot
 from utils.io import save, save_json, save_figure
 from utils.experiment import get_transforms, get_normalizer
 from utils.WaveDataset import WaveDataset
+from models.ensemble import MCDropoutEnsemble
 
 
 def image_prepro(image, normalizer):
@@ -76,9 +77,9 @@ def get_sample_predictions(model, refeed, dataloader, dataset_name, device, figu
     logging.info('Sample predictions finished in %.1fs' % (time.time() - time_start))
 
 
-def create_evaluation_dataloader(data_directory, normalizer_type):
+def create_evaluation_dataloader(data_directory, normalizer_type, num_workers=4, worker_init_fn=None, image_size=128):
     logging.info('Creating evaluation dataset %s' % data_directory)
-    transform = get_transforms(get_normalizer(normalizer_type))
+    transform = get_transforms(get_normalizer(normalizer_type), image_size)
 
     classes = [dI for dI in os.listdir(data_directory) if os.path.isdir(os.path.join(data_directory, dI))]
     # classes = os.listdir(data_directory)
@@ -89,7 +90,7 @@ def create_evaluation_dataloader(data_directory, normalizer_type):
 
     dataset_info = [data_directory, classes, imagesets[:125]]
     dataset = WaveDataset(dataset_info, transform["Test"])
-    return DataLoader(dataset, batch_size=4, shuffle=False, num_workers=4)
+    return DataLoader(dataset, batch_size=4, shuffle=False, num_workers=num_workers, worker_init_fn=worker_init_fn)
 
 
 def evaluate_experiment(experiment, args_new):
@@ -104,20 +105,29 @@ def evaluate_experiment(experiment, args_new):
                    # "Shallow_Depth": create_evaluation_dataloader(os.path.join(experiment.dirs['data'], 'Shallow_Depth/'), experiment.args.normalizer_type),
                    # "Smaller_Tub": create_evaluation_dataloader(os.path.join(experiment.dirs['data'], 'Smaller_Tub/'), experiment.args.normalizer_type),
                    # "Bigger_Tub": create_evaluation_dataloader(os.path.join(experiment.dirs['data'], 'Bigger_Tub/'), experiment.args.normalizer_type),
-                    "Fixed_tub_10": create_evaluation_dataloader(os.path.join(experiment.dirs['data'], 'Fixed_tub_10/'), experiment.args.normalizer_type)
+                    "Fixed_tub_10": create_evaluation_dataloader(os.path.join(experiment.dirs['data'], 'Fixed_tub_10/'), experiment.args.normalizer_type,
+                                                                 experiment.resources['num_workers'], experiment.worker_init_fn, args_new.image_size)
 
                    }
 
+    model = experiment.model
+    if args_new.ensemble_size > 1:
+        model = MCDropoutEnsemble(experiment.model, args_new.ensemble_size)
+
     for dataset_name, dataloader in dataloaders.items():
         logging.info("Evaluating dataset: %s" % dataset_name)
         evaluator = Evaluator(args_new.test_starting_point, dataset_name, experiment.normalizer)
-        evaluator.compute_experiment_metrics(experiment.model, experiment.args_new.refeed, dataloader, args_new.num_total_output_frames, experiment.device, debug=args_new.debug)
+        evaluator.compute_experiment_metrics(model, experiment.args_new.refeed, dataloader, args_new.num_total_output_frames, experiment.device, debug=args_new.debug)
+        if evaluator.spread:
+            spread_error, correlation = evaluator.get_spread_error()
+            logging.info('Ensemble of %d: mean spread %.4f, mean RMSE %.4f, spread-error correlation %.3f' %
+                         (args_new.ensemble_size, spread_error['Spread'].mean(), spread_error['RMSE'].mean(), correlation))
         evaluator.save_metrics_plots(experiment.dirs['charts'])
         evaluator.save_to_file(experiment.files['evaluator'] % (dataset_name, args_new.test_starting_point))
         # Get the sample plots after you compute everything else because the dataloader iterates from the beginning
         if args_new.get_sample_predictions:
             logging.info("Generate prediction plots for %s" % dataset_name)
-            get_sample_predictions(experiment.model, args_new.refeed, dataloader, dataset_name, experiment.device, experiment.dirs['predictions'], experiment.normalizer, args_new.debug)
+            get_sample_predictions(model, args_new.refeed, dataloader, dataset_name, experiment.device, experiment.dirs['predictions'], experiment.normalizer, args_new.debug)
         logging.info('Elapsed time: %.0f' % (time.time() - start_time))
         if args_new.debug:
             break
@@ -168,6 +178,9 @@ class Evaluator():
                       "MSE_flat_image_val": [],
                       "MSE_flat_image_frame": [],
                       "MSE_flat_image_hue": [],
+                      "Spread_val": [],
+                      "Spread_frame": [],
+                      "Spread_hue": [],
                       }
 
         self.own = False
@@ -175,6 +188,7 @@ class Evaluator():
         self.SSIM = False
         self.MSE = False
         self.phash2 = False
+        self.spread = False
 
     def get_rmse_values(self):
         df = pd.DataFrame.from_dict({'RMSE': self.state['MSE_val'],
@@ -216,15 +230,20 @@ class Evaluator():
                 num_real_output_frames = target_frames.shape[1]
 
                 # logging.info('num_real_output_frames %d' % num_real_output_frames)
-                self.compare_output_target(
-                    model.get_future_frames(batch_images[:, self.starting_point:input_end_point, :, :].to(device),
-                                            num_real_output_frames, refeed).cpu().numpy(), target_frames, last_input)
+                input_frames = batch_images[:, self.starting_point:input_end_point, :, :].to(device)
+                if hasattr(model, 'get_future_frames_with_variance'):
+                    output_frames, variance_frames = model.get_future_frames_with_variance(input_frames, num_real_output_frames, refeed)
+                    variance_frames = variance_frames.cpu().numpy()
+                else:
+                    output_frames = model.get_future_frames(input_frames, num_real_output_frames, refeed)
+                    variance_frames = None
+                self.compare_output_target(output_frames.cpu().numpy(), target_frames, last_input, variance_frames)
 
                 if debug:
                     print('batch_num %d\tSSIM %f' % (batch_num, self.state['SSIM_val'][-1]))
                     break
 
-    def compare_output_target(self, output_frames, target_frames, last_input_batch):
+    def compare_output_target(self, output_frames, target_frames, last_input_batch, variance_frames=None):
         batch_size = output_frames.shape[0]
         num_output_frames = output_frames.shape[1]
         flat_image = np.ones(output_frames.shape[2:], dtype='float32') * 0.5
@@ -242,6 +261,8 @@ class Evaluator():
                 last_input = image_prepro(last_input_batch[batch_index, 0, :, :], self.normalizer)
                 self.add_baseline('last_input', last_input, target, frame_index)
                 self.add_baseline('flat_image', flat_image, target, frame_index)
+                if variance_frames is not None:
+                    self.add_spread(variance_frames[batch_index, frame_index, :, :], frame_index)
 
     def add_baseline(self, name, predicted, target, frame_nr):
         self.state['SSIM_%s_val' % name].append(self.ssim(predicted, target))
@@ -251,6 +272,23 @@ class Evaluator():
         self.state['MSE_%s_frame' % name].append(frame_nr)
         self.state['MSE_%s_hue' % name].append("RMSE %s" % name.replace('_', ' ').title())
 
+    def add_spread(self, variance, frame_nr):
+        # Standard deviation of the ensemble in the units of the RMSE
+        self.state['Spread_val'].append(float(np.sqrt(np.mean(variance))) * self.normalizer['std'])
+        self.state['Spread_frame'].append(frame_nr)
+        self.state['Spread_hue'].append("Ensemble Spread")
+        self.spread = True
+
+    def get_spread_error(self):
+        """
+        Mean ensemble spread and RMSE per frame, and their correlation over all predictions.
+        The spread of a well calibrated ensemble is close to the RMSE
+        """
+        df = pd.DataFrame.from_dict({'Spread': self.state['Spread_val'],
+                                     'RMSE': self.state['MSE_val'],
+                                     'Frames': self.state['Spread_frame']})
+        return df.groupby('Frames').mean(), df['Spread'].corr(df['RMSE'])
+
     def add(self, predicted, target, frame_nr, *args):
         if "Own"in args:
             spatial_score, scale_score = self.score(predicted, target)
@@ -362,6 +400,16 @@ class Evaluator():
             sns.lineplot(x="Time-steps Ahead", y="Root Mean Square Error", hue="Scoring Type", data=pd.DataFrame.from_dict(all_data), ax=fig, ci='sd')
             save_figure(os.path.join(output_dir, "%s_RMSE_Quality_start_%02d" % (self.dataset_name, self.starting_point)), obj=fig)
 
+        if getattr(self, 'spread', False):
+            all_data = {}
+            all_data.update({"Time-steps Ahead": self.state['MSE_frame'] + self.state['Spread_frame'],
+                             "Root Mean Square Error": self.state['MSE_val'] + self.state['Spread_val'],
+                             "Scoring Type": self.state['MSE_hue'] + self.state['Spread_hue']})
+            fig = plt.figure().add_axes()
+            sns.set(style="darkgrid")  # darkgrid, whitegrid, dark, white, and ticks
+            sns.lineplot(x="Time-steps Ahead", y="Root Mean Square Error", hue="Scoring Type", data=pd.DataFrame.from_dict(all_data), ax=fig, ci='sd')
+            save_figure(os.path.join(output_dir, "%s_Spread_Error_start_%02d" % (self.dataset_name, self.starting_point)), obj=fig)
+
         if self.phash:
             all_data = {}
             all_data.update({"Time-steps Ahead": self.state['pHash_frame'], "Hamming Distance": self.state['pHash_val'], "Scoring Type": self.state['pHash_hue']})
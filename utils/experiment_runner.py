@@ -7,9 +7,34 @@ import os
 import numpy as np
 import time
 import logging
-from utils.experiment import save_network
+from utils.experiment import save_network, create_subset_dataloader
 from utils.experiment_evaluator import save_sequence_plots, get_test_predictions_pairs
 from utils.io import save_json
+from utils.distillation import TeacherCache
+from utils.profiler import StepProfiler, parse_step_range
+from utils.memory import reset_peak_memory, get_peak_memory, get_budgeted_memory, measure_training_step_memory
+
+
+def weighted_mse_loss(output_frames, target_frames, weights=None):
+    """
+    Returns the loss and the detached loss of every sequence of the batch. Without weights it is the plain MSE.
+    """
+    if weights is None:
+        return F.mse_loss(output_frames, target_frames), None
+    sequence_losses = ((output_frames - target_frames) ** 2).mean(dim=3).mean(dim=2).mean(dim=1)
+    return (sequence_losses * weights).mean(), sequence_losses.detach()
+
+
+def random_patch(batch_images, patch_size):
+    """
+    Crops the same random patch from every frame of the batch
+    """
+    height, width = batch_images.size(2), batch_images.size(3)
+    if patch_size >= height and patch_size >= width:
+        return batch_images
+    y = random.randint(0, max(height - patch_size, 0))
+    x = random.randint(0, max(width - patch_size, 0))
+    return batch_images[:, :, y:y + patch_size, x:x + patch_size]
 
 
 class ExperimentRunner(nn.Module):
@@ -30,6 +55,32 @@ class ExperimentRunner(nn.Module):
         self.model = experiment.model
         self.model.to(self.exp.device)
 
+        self.val_subset_data = None
+        if self.args.validation_subset < 1.0:
+            self.val_subset_data = create_subset_dataloader(self.val_data, self.args.validation_subset, self.args.seed)
+
+        self.truncated_bptt = self.args.tbptt_steps > 0 and hasattr(self.model, 'get_future_frames_chunks')
+        if self.args.tbptt_steps > 0 and not self.truncated_bptt:
+            logging.warning('Model %s is not recurrent, truncated backpropagation through time is ignored' % self.args.model_type)
+
+        self.patch_size = 0
+        if self.args.patch_size > 0:
+            if hasattr(self.model, 'set_tiling'):
+                self.patch_size = self.args.patch_size
+            else:
+                logging.warning('Model %s is not fully convolutional, patch training is ignored' % self.args.model_type)
+
+        self.teacher = None
+        if self.args.teacher_experiment is not None:
+            self.teacher = TeacherCache(experiment.load_teacher(), self.args.teacher_cache_size)
+            logging.info('Distilling from %s with alpha %.2f' % (self.args.teacher_experiment, self.args.distillation_alpha))
+
+        self.window_sampler = experiment.window_sampler
+        if self.window_sampler is not None:
+            logging.info('Sampling training windows by their loss with %.0f%% uniform mix' % (100 * self.window_sampler.uniform_mix))
+
+        self.profiler = StepProfiler(enabled=self.args.profile_stages, trace_steps=parse_step_range(self.args.profile_steps))
+
         self.best_val_model_loss = experiment.logger.get_best_val_loss()
         self.refeed = False
 
@@ -40,7 +91,33 @@ class ExperimentRunner(nn.Module):
 
         return total_num_params
 
-    def run_batch_iter(self, batch_images, train):
+    def get_windows(self, batch_images, train, sequence_indices=None):
+        """
+        Yields the input frames, target frames, importance weights and starting points of the windows of a batch.
+        Weights and starting points are None when the windows are sampled uniformly.
+        """
+        video_length = batch_images.size(1)
+        num_starting_points = video_length - self.args.num_input_frames - self.args.num_output_frames - 1
+        if not (train and self.window_sampler is not None and sequence_indices is not None):
+            for starting_point in random.sample(range(num_starting_points), self.args.samples_per_sequence):
+                input_end_point = starting_point + self.args.num_input_frames
+                with self.profiler.stage('clone'):
+                    input_frames = batch_images[:, starting_point:input_end_point, :, :].clone()
+                target_frames = batch_images[:, input_end_point:(input_end_point + self.args.num_output_frames), :, :]
+                yield input_frames, target_frames, None, None
+            return
+
+        starting_points, weights = self.window_sampler.sample(sequence_indices, num_starting_points, self.args.samples_per_sequence)
+        window_offsets = torch.arange(self.args.num_input_frames + self.args.num_output_frames)
+        for i in range(self.args.samples_per_sequence):
+            with self.profiler.stage('clone'):
+                # Every sequence of the batch has its own window
+                frame_indices = (starting_points[:, i:i + 1] + window_offsets).to(batch_images.device)
+                frame_indices = frame_indices[:, :, None, None].expand(-1, -1, batch_images.size(2), batch_images.size(3))
+                window = batch_images.gather(1, frame_indices)
+            yield window[:, :self.args.num_input_frames], window[:, self.args.num_input_frames:], weights[:, i].to(batch_images.device), starting_points[:, i]
+
+    def run_batch_iter(self, batch_images, train, sequence_indices=None):
         # Expects input of Batch Size x Video Length x Height x Width
         # Returns loss per each sequence prediction
         if train:
@@ -48,63 +125,186 @@ class ExperimentRunner(nn.Module):
         else:
             self.model.eval()
 
-        video_length = batch_images.size(1)
-        random_starting_points = random.sample(range(video_length - self.args.num_input_frames - self.args.num_output_frames - 1), self.args.samples_per_sequence)
+        if train and self.patch_size > 0:
+            batch_images = random_patch(batch_images, self.patch_size)
 
         batch_loss = 0
-        for starting_point in random_starting_points:
-            input_end_point = starting_point + self.args.num_input_frames
-            input_frames = batch_images[:, starting_point:input_end_point, :, :].clone()
-            output_frames = self.model.get_future_frames(input_frames, self.args.num_output_frames, self.refeed)
-            target_frames = batch_images[:, input_end_point:(input_end_point + self.args.num_output_frames), :, :]
-            # print('ER sizes out, tar', output_frames.size(), target_frames.size())
-            loss = F.mse_loss(output_frames, target_frames)
-            batch_loss += loss.item()
+        for input_frames, target_frames, weights, starting_points in self.get_windows(batch_images, train, sequence_indices):
+            if train and self.teacher is not None:
+                target_frames = self.get_distillation_target(input_frames, target_frames)
+            if train and self.truncated_bptt:
+                loss, sequence_losses = self.run_truncated_bptt_iter(input_frames, target_frames, weights)
+                batch_loss += loss
+                if weights is not None:
+                    self.window_sampler.update(sequence_indices, starting_points, sequence_losses)
+                continue
+            with self.profiler.stage('forward'):
+                output_frames = self.model.get_future_frames(input_frames, self.args.num_output_frames, self.refeed)
+                # print('ER sizes out, tar', output_frames.size(), target_frames.size())
+                loss, sequence_losses = weighted_mse_loss(output_frames, target_frames, weights)
 
             if train:
-                self.exp.lr_scheduler.optimizer.zero_grad()
-                loss.backward()
-                self.exp.lr_scheduler.optimizer.step()
+                with self.profiler.stage('backward'):
+                    self.exp.lr_scheduler.optimizer.zero_grad()
+                    loss.backward()
+                with self.profiler.stage('optimizer'):
+                    self.exp.lr_scheduler.optimizer.step()
+
+            with self.profiler.stage('sync'):
+                batch_loss += loss.item()
+                if weights is not None:
+                    self.window_sampler.update(sequence_indices, starting_points, sequence_losses.cpu())
 
             # if self.args.debug:
                 # logging.info('EXP RUNNER out tar size %s %s' % (output_frames.size(), target_frames.size()))
 
         return batch_loss / self.args.samples_per_sequence  # mean batch loss
 
+    def get_distillation_target(self, input_frames, target_frames):
+        # (1 - alpha) * MSE(output, target) + alpha * MSE(output, teacher) has the same gradients as the MSE to the blended target
+        with self.profiler.stage('teacher'):
+            teacher_frames = self.teacher.get_future_frames(input_frames, self.args.num_output_frames)
+        return (1 - self.args.distillation_alpha) * target_frames + self.args.distillation_alpha * teacher_frames
+
+    def run_truncated_bptt_iter(self, input_frames, target_frames, weights=None):
+        # The loss of every chunk is weighted by its length so that the gradients add up to those of the full window loss
+        self.exp.lr_scheduler.optimizer.zero_grad()
+        chunks = self.model.get_future_frames_chunks(input_frames, self.args.num_output_frames, self.args.tbptt_steps)
+        window_loss = 0
+        sequence_losses = 0
+        chunk_start = 0
+        while True:
+            with self.profiler.stage('forward'):
+                output_frames = next(chunks, None)
+                if output_frames is None:
+                    break
+                chunk_end = chunk_start + output_frames.size(1)
+                chunk_weight = (chunk_end - chunk_start) / self.args.num_output_frames
+                loss, chunk_sequence_losses = weighted_mse_loss(output_frames, target_frames[:, chunk_start:chunk_end, :, :], weights)
+                loss = loss * chunk_weight
+            with self.profiler.stage('backward'):
+                loss.backward()
+            with self.profiler.stage('sync'):
+                window_loss += loss.item()
+                if weights is not None:
+                    sequence_losses += chunk_sequence_losses.cpu() * chunk_weight
+            chunk_start = chunk_end
+        with self.profiler.stage('optimizer'):
+            self.exp.lr_scheduler.optimizer.step()
+        return window_loss, sequence_losses
+
+    def is_validation_epoch(self, epoch_num):
+        last_epoch = epoch_num == self.args.num_epochs - 1
+        return last_epoch or (epoch_num + 1) % self.args.validation_frequency == 0
+
+    def should_stop_early(self):
+        if self.args.early_stopping_patience <= 0:
+            return False
+        return self.exp.logger.get_epochs_since_best() >= self.args.early_stopping_patience
+
+    def run_validation(self, dataloader):
+        losses = []
+        with tqdm.tqdm(total=len(dataloader), ncols=40) as pbar_val:
+            for batch_images in dataloader:
+                batch_images = batch_images.to(self.exp.device)
+
+                with torch.no_grad():
+                    loss = self.run_batch_iter(batch_images, train=False)
+                losses.append(loss)  # add current iter loss to val loss list.
+                pbar_val.update(1)  # add 1 step to the progress bar
+                pbar_val.set_description("loss: {:.4f}".format(loss))
+                if self.args.debug:
+                    break
+        return losses, batch_images
+
+    def record_memory(self, phase, epoch_num):
+        memory = get_peak_memory()
+        self.exp.logger.record_memory(memory, phase, epoch_num)
+        logging.info('Peak %s memory: RSS %.0fMB allocated %s' % (phase, memory['rss'], 'n/a' if memory['allocated'] is None else '%.0fMB' % memory['allocated']))
+        if self.args.memory_budget > 0 and get_budgeted_memory(memory) > self.args.memory_budget:
+            logging.warning('Peak %s memory %.0fMB exceeds the memory budget of %.0fMB' % (phase, get_budgeted_memory(memory), self.args.memory_budget))
+        reset_peak_memory()
+
+    def check_memory_budget(self):
+        image_size = self.patch_size if self.patch_size > 0 else self.args.image_size
+        memory = measure_training_step_memory(self.model, self.args.batch_size, self.args.num_input_frames, self.args.num_output_frames, self.exp.device, image_size,
+                                              tbptt_steps=self.args.tbptt_steps if self.truncated_bptt else 0)
+        logging.info('Estimated training step memory: %.0fMB' % get_budgeted_memory(memory))
+        if get_budgeted_memory(memory) > self.args.memory_budget:
+            logging.warning('Model %s with batch size %d and %d output frames is likely to exceed the memory budget of %.0fMB' %
+                            (self.args.model_type, self.args.batch_size, self.args.num_output_frames, self.args.memory_budget))
+
     def run_experiment(self):
         logging.info('Start training at epoch %s / %s' % (self.exp.starting_epoch, self.args.num_epochs))
+        if self.args.memory_budget > 0:
+            self.check_memory_budget()
+        reset_peak_memory()
         for epoch_num in range(self.exp.starting_epoch, self.args.num_epochs):
+            if self.should_stop_early():
+                logging.info('Early stopping: no improvement for %d epochs since epoch %d' % (self.exp.logger.get_epochs_since_best(), self.exp.logger.get_best_epoch_nr()))
+                break
             logging.info('Epoch: %d' % epoch_num)
             epoch_start_time = time.time()
-            current_epoch_losses = {"train_loss": [], "validation_loss": []}
-            with tqdm.tqdm(total=len(self.train_data), ncols=40) as pbar_train:  # create a progress bar for training
-                for batch_num, batch_images in enumerate(self.train_data):
+            if epoch_num == self.exp.starting_epoch and self.exp.resumed_epoch_losses is not None:
+                starting_batch = self.exp.starting_batch
+                current_epoch_losses = self.exp.resumed_epoch_losses
+                logging.info('Resuming epoch %d from batch %d' % (epoch_num, starting_batch))
+            else:
+                starting_batch = 0
+                current_epoch_losses = {"train_loss": [], "validation_loss": []}
+            batch_images = None
+            with tqdm.tqdm(total=len(self.train_data), initial=starting_batch, ncols=40) as pbar_train:  # create a progress bar for training
+                data_wait_start_time = time.time()
+                for batch_num, batch_images in enumerate(self.train_data, start=starting_batch):
                     # logging.info('BATCH: %d' % batch_num )
                     batch_start_time = time.time()
-                    batch_images = batch_images.to(self.exp.device)
-                    loss = self.run_batch_iter(batch_images, train=True)
+                    self.profiler.update_trace(len(self.exp.logger.logs['batch_nr']), self.exp.files['trace'])
+                    self.profiler.start_step()
+                    self.profiler.add('data_wait', batch_start_time - data_wait_start_time)
+                    with self.profiler.stage('transfer'):
+                        batch_images = batch_images.to(self.exp.device)
+                    sequence_indices = None
+                    if self.window_sampler is not None:
+                        sequence_indices = self.train_data.sampler.permutation[batch_num * self.args.batch_size:(batch_num + 1) * self.args.batch_size]
+                    loss = self.run_batch_iter(batch_images, train=True, sequence_indices=sequence_indices)
                     current_epoch_losses["train_loss"].append(loss)
                     self.exp.logger.record_loss_batchwise(loss, batch_increment=1)
+                    stage_times = self.profiler.end_step()
                     batch_time = time.time() - batch_start_time
                     pbar_train.update(1)
-                    pbar_train.set_description("loss: {:.4f} time: {:.1f}s".format(loss, batch_time))
-                    if self.args.debug:
-                        break
-            with tqdm.tqdm(total=len(self.val_data), ncols=40) as pbar_val:  #
-                for batch_images in self.val_data:
-                    batch_images = batch_images.to(self.exp.device)
-
-                    with torch.no_grad():
-                        loss = self.run_batch_iter(batch_images, train=False)
-                    current_epoch_losses["validation_loss"].append(loss)  # add current iter loss to val loss list.
-                    pbar_val.update(1)  # add 1 step to the progress bar
-                    pbar_val.set_description("loss: {:.4f}".format(loss))
+                    if self.profiler.enabled:
+                        self.exp.logger.record_stage_times(stage_times, epoch_num)
+                        pbar_train.set_description("loss: {:.4f} data: {:.1f}s step: {:.1f}s".format(loss, stage_times['data_wait'], batch_time))
+                    else:
+                        pbar_train.set_description("loss: {:.4f} time: {:.1f}s".format(loss, batch_time))
+                    if self.args.checkpoint_frequency > 0 and (batch_num + 1) % self.args.checkpoint_frequency == 0:
+                        self.exp.save_checkpoint(epoch_num, batch_num + 1, current_epoch_losses)
                     if self.args.debug:
                         break
+                    data_wait_start_time = time.time()
+            if self.args.activation_checkpointing > 0:
+                logging.info('Activation checkpointing every %d steps: peak train memory %.0fMB, train time %.1fs' %
+                             (self.args.activation_checkpointing, get_budgeted_memory(get_peak_memory()), time.time() - epoch_start_time))
+            self.record_memory('train', epoch_num)
+            if self.teacher is not None:
+                self.teacher.log_stats()
+            current_train_loss = np.mean(current_epoch_losses['train_loss'])
+            current_validation_loss = np.nan
+            if self.is_validation_epoch(epoch_num):
+                if self.val_subset_data is not None:
+                    validation_subset_losses, batch_images = self.run_validation(self.val_subset_data)
+                    validation_subset_loss = np.mean(validation_subset_losses)
+                    run_full_validation = validation_subset_loss < self.exp.logger.get_best_val_subset_loss()
+                    self.exp.logger.record_validation_subset_loss(validation_subset_loss, epoch_num)
+                    logging.info('Validation subset loss: %.4f' % validation_subset_loss)
+                else:
+                    run_full_validation = True
+                if run_full_validation:
+                    current_epoch_losses["validation_loss"], batch_images = self.run_validation(self.val_data)
+                    current_validation_loss = np.mean(current_epoch_losses['validation_loss'])
+                self.record_memory('val', epoch_num)
 
             #  get mean of all metrics of current epoch metrics dict, to get them ready for storage and output on the terminal.
-            current_train_loss = np.mean(current_epoch_losses['train_loss'])
-            current_validation_loss = np.mean(current_epoch_losses['validation_loss'])
             self.exp.logger.record_epoch_losses(current_train_loss, current_validation_loss, epoch_num)
             self.exp.logger.save_to_json(self.exp.files['logger'])
             self.exp.logger.save_validation_loss_plot(self.exp.dirs['training'])
@@ -123,7 +323,13 @@ class ExperimentRunner(nn.Module):
                 save_network(self.model, os.path.join(self.exp.files['model_best']))
 
             # Plot test predictions during training. Cool!
-            output_frames, target_frames = get_test_predictions_pairs(self.model, self.refeed, batch_images, self.args.test_starting_point, self.args.num_total_output_frames)
-            save_sequence_plots(epoch_num, self.args.test_starting_point, output_frames, target_frames, self.exp.dirs['training'], self.exp.normalizer, 'Training')
+            if batch_images is not None:
+                output_frames, target_frames = get_test_predictions_pairs(self.model, self.refeed, batch_images, self.args.test_starting_point, self.args.num_total_output_frames)
+                save_sequence_plots(epoch_num, self.args.test_starting_point, output_frames, target_frames, self.exp.dirs['training'], self.exp.normalizer, 'Training')
+                self.record_memory('test_plot', epoch_num)
 
+            if self.profiler.enabled:
+                breakdown = self.exp.logger.get_stage_breakdown(epoch_num)
+                logging.info('Step breakdown: ' + ' | '.join('%s %.0f%%' % (stage, 100 * values['fraction']) for stage, values in breakdown.items()))
             self.exp.logger.save_training_progress(self.exp.files['progress'])
+            self.exp.save_checkpoint(epoch_num + 1, 0, None)
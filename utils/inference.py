@@ -0,0 +1,86 @@
+import torch
+import torch.nn as nn
+from models.ensemble import DROPOUT_TYPES
+
+# Convolutional models whose forward takes the frames and only reshapes (never views) its activations
+CHANNELS_LAST_MODELS = ['resnet', 'resnet_dilated', 'unet', 'unet_small']
+# Pairs of attributes that are run one after the other in forward (ResNet and its blocks)
+FOLD_ATTRIBUTES = [('conv1', 'bn1'), ('conv2', 'bn2')]
+# Largest absolute difference between the predictions of the original and the optimized model that is expected
+INFERENCE_TOLERANCE = 1e-3
+
+
+def fold_batch_norm(conv, bn):
+    """
+    Folds the running statistics and affine parameters of an eval mode batch norm into the preceding convolution
+    """
+    scale = 1. / torch.sqrt(bn.running_var + bn.eps)
+    shift = -bn.running_mean * scale
+    if bn.affine:
+        scale = scale * bn.weight
+        shift = shift * bn.weight + bn.bias
+    with torch.no_grad():
+        if isinstance(conv, nn.ConvTranspose2d):
+            # in_channels x out_channels x kH x kW
+            conv.weight.mul_(scale.view(1, -1, 1, 1))
+        else:
+            conv.weight.mul_(scale.view(-1, 1, 1, 1))
+        bias = conv.bias if conv.bias is not None else torch.zeros_like(scale)
+        bias = bias * scale + shift
+    conv.bias = nn.Parameter(bias.detach())
+
+
+def _foldable(conv, bn):
+    return (isinstance(conv, (nn.Conv2d, nn.ConvTranspose2d)) and isinstance(bn, nn.BatchNorm2d)
+            and conv.groups == 1 and bn.track_running_stats and conv.out_channels == bn.num_features)
+
+
+def fold_batch_norms(model):
+    """
+    Folds every batch norm that directly follows a convolution, in a Sequential or as a known attribute pair,
+    and replaces it by an identity. Returns the number of folded layers
+    """
+    num_folded = 0
+    for module in list(model.modules()):
+        if isinstance(module, nn.Sequential):
+            names = list(module._modules.keys())
+            pairs = zip(names[:-1], names[1:])
+        else:
+            pairs = FOLD_ATTRIBUTES
+        for conv_name, bn_name in pairs:
+            conv, bn = getattr(module, conv_name, None), getattr(module, bn_name, None)
+            if _foldable(conv, bn):
+                fold_batch_norm(conv, bn)
+                setattr(module, bn_name, nn.Identity())
+                num_folded += 1
+    return num_folded
+
+
+def freeze_dropouts(model):
+    # Dropout stays off even if the model is put back in training mode
+    num_frozen = 0
+    for module in list(model.modules()):
+        for name, child in module.named_children():
+            if isinstance(child, DROPOUT_TYPES):
+                setattr(module, name, nn.Identity())
+                num_frozen += 1
+    return num_frozen
+
+
+def _to_channels_last(module, inputs):
+    return tuple(x.contiguous(memory_format=torch.channels_last) if torch.is_tensor(x) and x.dim() == 4 else x for x in inputs)
+
+
+def optimize_for_inference(model, channels_last=True, freeze_dropout=True):
+    """
+    Folds batch norms into the convolutions, removes dropout and converts the weights and the inputs of forward
+    to the channels-last memory format (torch >= 1.5). The model is left in eval mode. Returns what was changed
+    """
+    model.eval()
+    changes = {'folded_batch_norms': fold_batch_norms(model),
+               'frozen_dropouts': freeze_dropouts(model) if freeze_dropout else 0,
+               'channels_last': channels_last and hasattr(torch, 'channels_last')}
+    if changes['channels_last']:
+        model.to(memory_format=torch.channels_last)
+        model.register_forward_pre_hook(_to_channels_last)
+    return changes
@@ -1,10 +1,20 @@
 import pickle
 import os
 import json
+import configparser
 import pandas as pd
 import numpy
 import matplotlib.pyplot as plt
 
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def get_experiment_dir(exp_name):
+    # Same lookup as Experiment, which runs with the repository as working directory
+    config = configparser.ConfigParser()
+    config.read(os.path.join(ROOT_DIR, '..', 'config.ini'))
+    return os.path.join(config['paths']['experiments'], exp_name)
+
 
 def save_figure(destination, obj=None):
     plt.tight_layout()
@@ -0,0 +1,110 @@
+import copy
+import resource
+import torch
+
+
+def reset_peak_memory():
+    # Linux resets the peak resident set size (VmHWM) of the process when 5 is written to clear_refs
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except (IOError, OSError):
+        pass
+    if torch.cuda.is_available():
+        if hasattr(torch.cuda, 'reset_peak_memory_stats'):
+            torch.cuda.reset_peak_memory_stats()
+        else:
+            torch.cuda.reset_max_memory_allocated()
+
+
+def get_peak_rss():
+    """
+    Peak resident set size of the process in MB
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024.
+    except (IOError, OSError):
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.  # kB on Linux
+
+
+def get_current_rss():
+    """
+    Resident set size of the process in MB, None where /proc is not available
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024.
+    except (IOError, OSError):
+        pass
+    return None
+
+
+def get_peak_allocated():
+    """
+    Peak memory held by tensors in the CUDA caching allocator in MB. None on CPU
+    """
+    if torch.cuda.is_available():
+        return torch.cuda.max_memory_allocated() / 2**20
+    return None
+
+
+def get_peak_memory():
+    return {'rss': get_peak_rss(), 'allocated': get_peak_allocated()}
+
+
+def get_budgeted_memory(memory):
+    # On GPU the allocator is what runs out, on CPU the whole process
+    return memory['allocated'] if memory['allocated'] is not None else memory['rss']
+
+
+def measure_training_step_memory(model, batch_size, num_input_frames, num_output_frames, device, image_size=128, tbptt_steps=0):
+    """
+    Runs one forward and backward pass on a dummy batch and returns the peak memory in MB.
+    The model parameters, buffers and random number generators are left untouched.
+    The Adam moments that are not allocated yet are added to the estimate.
+    """
+    state = copy.deepcopy(model.state_dict())
+    model.train()
+    reset_peak_memory()
+    devices = None if torch.cuda.is_available() else []
+    with torch.random.fork_rng(devices=devices):
+        input_frames = torch.zeros(batch_size, num_input_frames, image_size, image_size, device=device)
+        if tbptt_steps > 0 and hasattr(model, 'get_future_frames_chunks'):
+            for output_frames in model.get_future_frames_chunks(input_frames, num_output_frames, tbptt_steps):
+                output_frames.mean().backward()
+        else:
+            output_frames = model.get_future_frames(input_frames, num_output_frames, False)
+            output_frames.mean().backward()
+    memory = get_peak_memory()
+    for param in model.parameters():
+        param.grad = None
+    model.load_state_dict(state)
+
+    optimizer_memory = 2 * sum(p.numel() * p.element_size() for p in model.parameters() if p.requires_grad) / 2**20
+    if memory['allocated'] is not None:
+        memory['allocated'] += optimizer_memory
+    else:
+        memory['rss'] += optimizer_memory
+    return memory
+
+
+def get_total_memory():
+    """
+    Memory that can be budgeted in MB: the CUDA device memory on GPU, the available system memory on CPU
+    """
+    if torch.cuda.is_available():
+        return torch.cuda.get_device_properties(torch.cuda.current_device()).total_memory / 2**20
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) / 1024.
+    except (IOError, OSError):
+        pass
+    return None
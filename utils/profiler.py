@@ -0,0 +1,86 @@
+import logging
+import time
+import torch
+from contextlib import contextmanager
+
+
+def parse_step_range(step_range):
+    """
+    Parses a string of the form 'a:b' into the tuple (a, b)
+    """
+    if step_range is None:
+        return None
+    start, end = step_range.split(':')
+    start, end = int(start), int(end)
+    if end <= start:
+        raise ValueError('Invalid step range %s' % step_range)
+    return start, end
+
+
+class StepProfiler():
+    """
+    Times the stages of every training step and optionally captures a torch profiler trace for a range of steps.
+    CUDA is synchronised around every stage so that asynchronous kernels are charged to the stage that launched them.
+    """
+    def __init__(self, enabled=False, trace_steps=None):
+        self.enabled = enabled
+        self.synchronize = enabled and torch.cuda.is_available()
+        self.trace_steps = trace_steps
+        self.trace = None
+        self.recording = False
+        self.times = {}
+
+    def _sync(self):
+        if self.synchronize:
+            torch.cuda.synchronize()
+
+    def start_step(self):
+        self.recording = self.enabled
+        self.times = {}
+
+    def end_step(self):
+        self.recording = False
+        return self.times
+
+    def add(self, name, elapsed_time):
+        if self.recording:
+            self.times[name] = self.times.get(name, 0.0) + elapsed_time
+
+    @contextmanager
+    def stage(self, name):
+        if not self.recording and self.trace is None:
+            yield
+            return
+        self._sync()
+        start_time = time.time()
+        if self.trace is not None:
+            with torch.autograd.profiler.record_function(name):
+                yield
+        else:
+            yield
+        self._sync()
+        self.add(name, time.time() - start_time)
+
+    def update_trace(self, step, filename):
+        """
+        Starts the trace at the first step of the range and stops it at the last one
+        """
+        if self.trace_steps is None:
+            return
+        start, end = self.trace_steps
+        if step == start and self.trace is None:
+            logging.info('Starting profiler trace at step %d' % step)
+            if hasattr(torch, 'profiler'):
+                activities = [torch.profiler.ProfilerActivity.CPU]
+                if torch.cuda.is_available():
+                    activities.append(torch.profiler.ProfilerActivity.CUDA)
+                self.trace = torch.profiler.profile(activities=activities, record_shapes=True, profile_memory=True)
+            else:
+                self.trace = torch.autograd.profiler.profile(use_cuda=torch.cuda.is_available())
+            self.trace.__enter__()
+        elif step == end and self.trace is not None:
+            self.trace.__exit__(None, None, None)
+            self.trace.export_chrome_trace(filename)
+            logging.info('Profiler trace of steps %d:%d saved to %s' % (start, end, filename))
+            logging.info(self.trace.key_averages().table(sort_by='self_cpu_time_total', row_limit=20))
+            self.trace = None
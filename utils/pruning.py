@@ -0,0 +1,89 @@
+import torch
+import torch.nn as nn
+from collections import OrderedDict
+from models.ResNet import BasicBlock
+
+# Models built from the units below, whose forward takes only the input frames
+PRUNABLE_MODELS = ['resnet', 'resnet_dilated', 'unet', 'unet_small']
+
+
+def get_prunable_units(model):
+    """
+    Channels that are internal to a block and can be removed without touching the rest of the network:
+    the middle channels of the UNet double convolutions and of the ResNet basic blocks.
+    Returns name -> (producing conv, batch norm or None, consuming conv)
+    """
+    units = OrderedDict()
+    for name, module in model.named_modules():
+        if isinstance(module, BasicBlock):
+            units[name] = (module.conv1, module.bn1, module.conv2)
+        elif isinstance(module, nn.Sequential) and len(module) == 4 and isinstance(module[0], nn.Conv2d) and isinstance(module[2], nn.Conv2d):
+            units[name] = (module[0], None, module[2])
+    return units
+
+
+def _set_unit(model, name, producer, bn, consumer):
+    module = model.get_submodule(name) if hasattr(model, 'get_submodule') else dict(model.named_modules())[name]
+    if isinstance(module, BasicBlock):
+        module.conv1, module.bn1, module.conv2 = producer, bn, consumer
+    else:
+        module[0], module[2] = producer, consumer
+
+
+def _conv_like(conv, in_channels, out_channels):
+    return nn.Conv2d(in_channels, out_channels, conv.kernel_size, stride=conv.stride, padding=conv.padding,
+                     dilation=conv.dilation, groups=conv.groups, bias=conv.bias is not None).to(conv.weight.device)
+
+
+def _prune_unit(producer, bn, consumer, keep):
+    keep = torch.tensor(keep, dtype=torch.long, device=producer.weight.device)
+    new_producer = _conv_like(producer, producer.in_channels, len(keep))
+    new_consumer = _conv_like(consumer, len(keep), consumer.out_channels)
+    with torch.no_grad():
+        new_producer.weight.copy_(producer.weight[keep])
+        if producer.bias is not None:
+            new_producer.bias.copy_(producer.bias[keep])
+        new_consumer.weight.copy_(consumer.weight[:, keep])
+        if consumer.bias is not None:
+            new_consumer.bias.copy_(consumer.bias)
+    new_bn = None
+    if bn is not None:
+        new_bn = nn.BatchNorm2d(len(keep), eps=bn.eps, momentum=bn.momentum).to(bn.weight.device)
+        with torch.no_grad():
+            new_bn.weight.copy_(bn.weight[keep])
+            new_bn.bias.copy_(bn.bias[keep])
+            new_bn.running_mean.copy_(bn.running_mean[keep])
+            new_bn.running_var.copy_(bn.running_var[keep])
+    return new_producer, new_bn, new_consumer
+
+
+def get_channel_importance(producer, bn, method):
+    if method == 'bn' and bn is not None:
+        return bn.weight.detach().abs()
+    return producer.weight.detach().abs().sum(dim=(1, 2, 3))
+
+
+def prune_model(model, amount, method='l1'):
+    """
+    Removes the fraction amount of the internal channels of every block, ranked by the L1 norm of their filters
+    or by their batch norm scale (method bn, falls back to L1 for blocks without batch norm).
+    Returns the pruning spec: the number of channels kept per block.
+    """
+    spec = OrderedDict()
+    for name, (producer, bn, consumer) in get_prunable_units(model).items():
+        importance = get_channel_importance(producer, bn, method)
+        num_keep = max(1, int(round(len(importance) * (1 - amount))))
+        keep = sorted(torch.argsort(importance, descending=True)[:num_keep].tolist())
+        _set_unit(model, name, *_prune_unit(producer, bn, consumer, keep))
+        spec[name] = num_keep
+    return spec
+
+
+def apply_pruning_spec(model, spec):
+    """
+    Shrinks a freshly created model to the shapes of a pruned one, so that its state dict can be loaded
+    """
+    for name, (producer, bn, consumer) in get_prunable_units(model).items():
+        if name in spec:
+            _set_unit(model, name, *_prune_unit(producer, bn, consumer, list(range(spec[name]))))
+    return model
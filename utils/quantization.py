@@ -0,0 +1,98 @@
+import torch
+import torch.nn as nn
+from models.rollout import rollout
+
+# Models whose forward is a plain tensor graph, these can be traced by FX
+QUANTIZABLE_MODELS = ['resnet', 'resnet_dilated', 'unet', 'unet_small']
+
+
+def get_quantize_fx():
+    try:
+        from torch.ao.quantization import quantize_fx
+    except ImportError:
+        try:
+            from torch.quantization import quantize_fx
+        except ImportError:
+            raise Warning('Static quantization needs FX graph mode, torch >= 1.8')
+    return quantize_fx
+
+
+def get_quantized_engine():
+    # x86 and fbgemm for Intel/AMD, qnnpack for ARM
+    for engine in ['x86', 'fbgemm', 'qnnpack']:
+        if engine in torch.backends.quantized.supported_engines:
+            return engine
+    raise Warning('This build of torch has no quantized engine')
+
+
+class QuantizedModel(nn.Module):
+    """
+    Int8 network with the rollout interface of the float models. The network is an FX GraphModule
+    or the TorchScript module it is saved as, and runs on the CPU only
+    """
+    def __init__(self, network, num_input_frames, num_output_frames):
+        super(QuantizedModel, self).__init__()
+        self.network = network
+        self.num_input_frames = num_input_frames
+        self.num_output_frames = num_output_frames
+
+    def forward(self, x):
+        return self.network(x)
+
+    def rollout_step(self, input_frames):
+        return self(input_frames)
+
+    def get_future_frames(self, input_frames, num_total_output_frames, refeed):
+        return rollout(self.rollout_step, input_frames, num_total_output_frames, self.get_num_input_frames())
+
+    def get_num_input_frames(self):
+        return self.num_input_frames
+
+    def get_num_output_frames(self):
+        return self.num_output_frames
+
+
+def calibrate(network, dataloader, num_input_frames, num_total_output_frames, num_batches, starting_point=0):
+    """
+    Runs rollouts on the first num_batches batches, so that the observers also see the ranges of refed predictions
+    """
+    with torch.no_grad():
+        for batch_num, batch_images in enumerate(dataloader):
+            if batch_num == num_batches:
+                break
+            input_frames = batch_images[:, starting_point:starting_point + num_input_frames]
+            rollout(network, input_frames, num_total_output_frames, num_input_frames)
+
+
+def quantize_model(model, dataloader, num_total_output_frames, num_batches, starting_point=0):
+    """
+    Static int8 quantization of a float model on the CPU. The batch norms are fused into the convolutions,
+    the activation ranges are calibrated on num_batches batches of dataloader. The float model is changed in place
+    """
+    quantize_fx = get_quantize_fx()
+    engine = get_quantized_engine()
+    torch.backends.quantized.engine = engine
+    model = model.cpu().eval()
+    num_input_frames = model.get_num_input_frames()
+    example_input = next(iter(dataloader))[:1, :num_input_frames]
+    try:
+        from torch.ao.quantization import get_default_qconfig_mapping
+        prepared = quantize_fx.prepare_fx(model, get_default_qconfig_mapping(engine), (example_input,))
+    except ImportError:
+        prepared = quantize_fx.prepare_fx(model, {'': torch.quantization.get_default_qconfig(engine)})
+    calibrate(prepared, dataloader, num_input_frames, num_total_output_frames, num_batches, starting_point)
+    network = quantize_fx.convert_fx(prepared)
+    return QuantizedModel(network, num_input_frames, model.get_num_output_frames())
+
+
+def save_quantized_model(model, filename, image_size):
+    # TorchScript, so that the artifact can be loaded without the model code. Traced at the evaluation resolution
+    example_input = torch.zeros(1, model.get_num_input_frames(), image_size, image_size)
+    with torch.no_grad():
+        traced = torch.jit.trace(model.network, example_input)
+    torch.jit.save(traced, filename)
+
+
+def load_quantized_model(filename, num_input_frames, num_output_frames):
+    torch.backends.quantized.engine = get_quantized_engine()
+    return QuantizedModel(torch.jit.load(filename, map_location='cpu'), num_input_frames, num_output_frames)
@@ -0,0 +1,115 @@
+import copy
+import logging
+import multiprocessing
+import os
+import time
+import torch
+import torch.nn.functional as F
+from torch.utils.data import DataLoader
+
+
+def get_available_cores():
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count()))
+
+
+def plan_resources(num_workers, cores=None, inter_op_threads=1):
+    """
+    Splits the cores between the DataLoader workers, which get one core each, and the main process,
+    whose cores are shared by its intra-op and inter-op threads
+    """
+    if cores is None:
+        cores = get_available_cores()
+    num_workers = max(0, min(num_workers, len(cores) - 1))
+    main_cores = cores[:len(cores) - num_workers]
+    worker_cores = cores[len(cores) - num_workers:]
+    inter_op_threads = max(1, min(inter_op_threads, len(main_cores)))
+    return {'num_cores': len(cores),
+            'num_workers': num_workers,
+            'intra_op_threads': len(main_cores) - inter_op_threads + 1,
+            'inter_op_threads': inter_op_threads,
+            'main_cores': main_cores,
+            'worker_cores': worker_cores}
+
+
+def apply_resource_plan(plan):
+    torch.set_num_threads(plan['intra_op_threads'])
+    try:
+        torch.set_num_interop_threads(plan['inter_op_threads'])
+    except RuntimeError:
+        # Can only be set once, before any inter-op parallel work has started
+        logging.info('Inter-op threads already set to %d' % torch.get_num_interop_threads())
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, plan['main_cores'])
+
+
+class PinnedWorkerInit():
+    """
+    DataLoader worker_init_fn that pins every worker to its own core and keeps it single threaded
+    """
+    def __init__(self, worker_cores):
+        self.worker_cores = worker_cores
+
+    def __call__(self, worker_id):
+        torch.set_num_threads(1)
+        if len(self.worker_cores) > 0 and hasattr(os, 'sched_setaffinity'):
+            os.sched_setaffinity(0, [self.worker_cores[worker_id % len(self.worker_cores)]])
+
+
+def measure_step_time(model, dataloader, num_input_frames, num_output_frames, device, num_batches=5):
+    """
+    Mean time of a training step including the wait for data. The first batch is excluded
+    because it includes the start-up of the workers. The model and random number generators are left untouched.
+    """
+    state = copy.deepcopy(model.state_dict())
+    model.train()
+    devices = None if torch.cuda.is_available() else []
+    with torch.random.fork_rng(devices=devices):
+        iterator = iter(dataloader)
+        next(iterator)
+        num_steps = 0
+        start_time = time.time()
+        for batch_images in iterator:
+            batch_images = batch_images.to(device)
+            input_frames = batch_images[:, :num_input_frames, :, :]
+            target_frames = batch_images[:, num_input_frames:(num_input_frames + num_output_frames), :, :]
+            output_frames = model.get_future_frames(input_frames, num_output_frames, False)
+            F.mse_loss(output_frames, target_frames).backward()
+            num_steps += 1
+            if num_steps == num_batches:
+                break
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        step_time = (time.time() - start_time) / max(num_steps, 1)
+    for param in model.parameters():
+        param.grad = None
+    model.load_state_dict(state)
+    return step_time
+
+
+def measure_plan_step_time(plan, model, dataset, batch_size, num_input_frames, num_output_frames, device):
+    """
+    Mean training step time with the threads, workers and affinity of plan. On the CPU every plan is measured in a
+    forked process, because a process can set its inter-op threads only once. CUDA cannot be used after a fork,
+    so there the plan is applied to this process and only its first inter-op setting takes effect
+    """
+    def measure():
+        apply_resource_plan(plan)
+        dataloader = DataLoader(dataset, batch_size=batch_size, shuffle=True,
+                                num_workers=plan['num_workers'], worker_init_fn=PinnedWorkerInit(plan['worker_cores']))
+        return measure_step_time(model, dataloader, num_input_frames, num_output_frames, device)
+
+    if next(model.parameters()).is_cuda:
+        return measure()
+
+    context = multiprocessing.get_context('fork')
+    queue = context.Queue()
+    process = context.Process(target=lambda: queue.put(measure()))
+    process.start()
+    process.join()
+    if process.exitcode != 0 or queue.empty():
+        logging.warning('Measuring %d workers, %d intra-op and %d inter-op threads failed' %
+                        (plan['num_workers'], plan['intra_op_threads'], plan['inter_op_threads']))
+        return float('inf')
+    return queue.get()
@@ -0,0 +1,84 @@
+import torch
+from torch.utils.data import Sampler
+
+
+class ResumableRandomSampler(Sampler):
+    """
+    Random sampler that remembers the permutation of the current epoch so that
+    an interrupted epoch can be resumed from the exact same position
+    """
+    def __init__(self, data_source):
+        self.data_source = data_source
+        self.permutation = None
+        self.resume_state = None
+
+    def __iter__(self):
+        if self.resume_state is not None:
+            self.permutation = self.resume_state['permutation']
+            start_index = self.resume_state['start_index']
+            self.resume_state = None
+        else:
+            self.permutation = torch.randperm(len(self.data_source)).tolist()
+            start_index = 0
+        return iter(self.permutation[start_index:])
+
+    def __len__(self):
+        return len(self.data_source)
+
+    def state_dict(self, num_consumed):
+        return {'permutation': self.permutation,
+                'start_index': num_consumed}
+
+    def load_state_dict(self, state):
+        self.resume_state = state
+
+
+class HardWindowSampler():
+    """
+    Samples the starting points of the training windows in proportion to a running estimate of their loss,
+    kept per sequence and starting point. Every window gets an importance weight of 1 / (num_offsets * q),
+    where q is the probability it was drawn with, so that the weighted loss is an unbiased estimate of the uniform one.
+    A fraction uniform_mix of the probability mass is spread uniformly so that no window is starved.
+    """
+    def __init__(self, num_sequences, uniform_mix=0.5, decay=0.9):
+        self.num_sequences = num_sequences
+        self.uniform_mix = uniform_mix
+        self.decay = decay
+        self.losses = None  # num_sequences x num_offsets, NaN where a window was never seen
+
+    def _init_table(self, num_offsets):
+        if self.losses is None or self.losses.size(1) != num_offsets:
+            self.losses = torch.full((self.num_sequences, num_offsets), float('nan'))
+
+    def probabilities(self, sequence_indices):
+        losses = self.losses[sequence_indices]
+        seen = self.losses[~torch.isnan(self.losses)]
+        fill_value = seen.mean().item() if seen.numel() > 0 else 1.0
+        losses = torch.where(torch.isnan(losses), torch.full_like(losses, fill_value), losses)
+        num_offsets = losses.size(1)
+        hard = losses / losses.sum(dim=1, keepdim=True).clamp(min=1e-12)
+        return self.uniform_mix / num_offsets + (1 - self.uniform_mix) * hard
+
+    def sample(self, sequence_indices, num_offsets, num_samples):
+        """
+        Returns the starting points and importance weights, both batch size x num_samples
+        """
+        self._init_table(num_offsets)
+        probabilities = self.probabilities(sequence_indices)
+        starting_points = torch.multinomial(probabilities, num_samples, replacement=True)
+        weights = 1. / (num_offsets * probabilities.gather(1, starting_points))
+        return starting_points, weights
+
+    def update(self, sequence_indices, starting_points, losses):
+        for sequence_index, starting_point, loss in zip(sequence_indices, starting_points.tolist(), losses.tolist()):
+            previous = self.losses[sequence_index, starting_point].item()
+            if previous != previous:  # NaN
+                self.losses[sequence_index, starting_point] = loss
+            else:
+                self.losses[sequence_index, starting_point] = self.decay * previous + (1 - self.decay) * loss
+
+    def state_dict(self):
+        return {'losses': self.losses}
+
+    def load_state_dict(self, state):
+        self.losses = state['losses']